@@ -1,4 +1,14 @@
+import json
+
 from django.contrib import admin
+from django.contrib.admin.views.main import (
+    PAGE_VAR,
+    ChangeList,
+)
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils import timezone
+from django.utils.functional import cached_property
 from reversion.admin import VersionAdmin
 
 from . import models
@@ -101,8 +111,105 @@ class JobAdmin(admin.ModelAdmin):
     pass
 
 
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator using PostgreSQL row estimates instead of `COUNT(*)`.
+
+    Unfiltered querysets use `reltuples` of the table and its partitions,
+    filtered ones the row estimate of `EXPLAIN`. Small estimates are replaced
+    by an exact count.
+    """
+
+    exact = 10000
+
+    @cached_property
+    def count(self):
+        qs = self.object_list
+        with connections[qs.db].cursor() as cursor:
+            if not qs.query.where:
+                cursor.execute(
+                    """
+                    SELECT sum(greatest(reltuples, 0)) FROM pg_class
+                    WHERE oid = to_regclass(%s) OR oid IN (
+                        SELECT inhrelid FROM pg_inherits
+                        WHERE inhparent = to_regclass(%s)
+                    )
+                    """,
+                    [qs.model._meta.db_table] * 2,
+                )
+                estimate = cursor.fetchone()[0] or 0
+            else:
+                sql, params = qs.query.sql_with_params()
+                cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+                plan = cursor.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                estimate = plan[0]["Plan"]["Plan Rows"]
+        if estimate < self.exact:
+            return super().count
+        return int(estimate)
+
+
+class ResultChangeList(ChangeList):
+    """
+    Change list with keyset navigation and a lazily loaded date hierarchy.
+
+    `older` links to the results preceding the last one shown using a
+    `modified__lt` filter, which stays fast on deep pages. The date hierarchy
+    is only rendered once a year was chosen, avoiding a scan over all rows for
+    distinct years.
+    """
+
+    def get_results(self, request):
+        super().get_results(request)
+        self.result_list = list(self.result_list)
+        self.older = None
+        if self.result_list:
+            last = self.result_list[-1].modified
+            self.older = self.get_query_string(
+                {"modified__lt": last.isoformat()}, [PAGE_VAR]
+            )
+        self.date_hierarchy_active = "modified__year" in self.params
+        self.date_hierarchy_start = self.get_query_string(
+            {"modified__year": timezone.now().year}, [PAGE_VAR]
+        )
+
+
 @admin.register(models.Result)
 class ResultAdmin(admin.ModelAdmin):
     date_hierarchy = "modified"
     list_filter = ("success", "function")
     list_display = ("pk", "target", "function", "success", "modified")
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_changelist(self, request, **kwargs):
+        return ResultChangeList
+
+    def changelist_view(self, request, extra_context=None):
+        request.defer_results = True
+        return super().changelist_view(request, extra_context)
+
+    def get_queryset(self, request):
+        qs = super().get_queryset(request)
+        if getattr(request, "defer_results", False):
+            qs = qs.defer("result", "data")
+        return qs
+
+
+class DispatchReturnInline(admin.TabularInline):
+    model = models.DispatchReturn
+    extra = 0
+    readonly_fields = ("minion", "success", "received")
+
+
+@admin.register(models.Dispatch)
+class DispatchAdmin(admin.ModelAdmin):
+    list_display = ("pk", "state", "created", "sent", "completion", "latency")
+    list_filter = ("state",)
+    search_fields = ("origins", "jids")
+    readonly_fields = ("completion", "latency")
+    inlines = (DispatchReturnInline,)
+
+    def get_queryset(self, request):
+        return models.Dispatch.with_returns(super().get_queryset(request))
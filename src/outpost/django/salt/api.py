@@ -1,38 +1,113 @@
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 from django.contrib.auth import (
     authenticate,
     login,
 )
 from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.http import StreamingHttpResponse
+from django.utils.http import (
+    parse_etags,
+    quote_etag,
+)
 from outpost.django.api.permissions import ExtendedDjangoModelPermissions
 from rest_framework import (
     exceptions,
     permissions,
+    status,
     viewsets,
 )
+from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 
 from . import (
     models,
+    renderers,
     serializers,
+    uploadhandlers,
 )
 from .conf import settings
+from .dispatch import dispatcher
 
 
 class HostViewSet(viewsets.ReadOnlyModelViewSet):
-    queryset = models.Host.objects.all()
+    queryset = models.Host.objects.select_related("system")
     serializer_class = serializers.HostSerializer
     permission_classes = (permissions.IsAuthenticated, ExtendedDjangoModelPermissions)
     lookup_field = "name"
     lookup_value_regex = "[^/]+"
 
+    def get_etag(self):
+        """
+        Version token of a host built from its system's modification time.
+
+        Returns `None` if serializer extensions are registered, as their data
+        is not covered by the modification time.
+        """
+        if serializers.HostSerializer.Meta.extensions:
+            return None
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        lookup = {self.lookup_field: self.kwargs[lookup_url_kwarg]}
+        qs = self.filter_queryset(self.get_queryset())
+        version = qs.filter(**lookup).values("pk", "system", "system__modified")
+        host = version.first()
+        if host is None:
+            return None
+        modified = host["system__modified"]
+        stamp = modified.timestamp() if modified else 0
+        return quote_etag(f"{host['pk']}-{host['system']}-{stamp}")
+
+    def retrieve(self, request, *args, **kwargs):
+        etag = self.get_etag()
+        if etag is None:
+            return super().retrieve(request, *args, **kwargs)
+        etags = parse_etags(request.META.get("HTTP_IF_NONE_MATCH", ""))
+        if etag in etags or "*" in etags:
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+        response = super().retrieve(request, *args, **kwargs)
+        response["ETag"] = etag
+        return response
+
+    @action(detail=True)
+    def changes(self, request, *args, **kwargs):
+        """
+        Pillar entries of the host's system changed after the version given
+        in `since`.
+
+        The full system pillar is returned instead if `since` is missing,
+        refers to another system or to changes no longer kept, or if the
+        system itself changed.
+        """
+        system = self.get_object().system
+        if system is None:
+            return Response({"version": None, "full": True, "system": None})
+        since = models.Change.since(system, request.query_params.get("since"))
+        version = models.Change.version(system)
+        changes = []
+        if since is not None:
+            changes = list(models.Change.objects.filter(system=system, txid__gte=since))
+        # Render the pillar after reading the journal so it is never older.
+        system.refresh_from_db(fields=("modified",))
+        pillar = serializers.SystemSerializer.cached(system)
+        if since is None or any(c.kind == "system" for c in changes):
+            return Response({"version": version, "full": True, "system": pillar})
+        data = serializers.SystemSerializer.delta(pillar, changes)
+        data.update({"version": version, "full": False})
+        return Response(data)
+
 
 class FileViewSet(viewsets.ModelViewSet):
     queryset = models.File.objects.all()
     serializer_class = serializers.FileSerializer
     permission_classes = (permissions.IsAuthenticated, ExtendedDjangoModelPermissions)
 
+    def initialize_request(self, request, *args, **kwargs):
+        request.upload_handlers = uploadhandlers.handlers(request)
+        return super().initialize_request(request, *args, **kwargs)
+
     def get_queryset(self):
         qs = super().get_queryset()
         return qs.filter(user__local=self.request.user)
@@ -47,6 +122,235 @@ class PublicKeyViewSet(viewsets.ModelViewSet):
         qs = super().get_queryset()
         return qs.filter(user=self.request.user)
 
+    @staticmethod
+    def entries(data):
+        """
+        Yield line numbers and entries from a JSON list of objects with
+        `username`, `key` and optional `name` or from an `authorized_keys`
+        style text in `keys` where each line is prefixed by a username.
+        """
+        if isinstance(data, list):
+            for line, entry in enumerate(data, 1):
+                if not isinstance(entry, dict):
+                    yield line, None
+                    continue
+                yield line, entry
+            return
+        if not hasattr(data, "get"):
+            yield 1, None
+            return
+        for line, text in enumerate(str(data.get("keys", "")).splitlines(), 1):
+            text = text.strip()
+            if not text or text.startswith("#"):
+                continue
+            username, _, key = text.partition(" ")
+            yield line, {"username": username, "key": key.strip()}
+
+    @staticmethod
+    def check(entry):
+        if not entry:
+            return "Not an object"
+        username, key, name = entry.get("username"), entry.get("key"), entry.get("name")
+        if not isinstance(username, str) or not username:
+            return "Username required"
+        if not isinstance(key, str) or not key:
+            return "Key required"
+        if name is not None and not isinstance(name, str):
+            return "Name has to be text"
+        max_length = models.PublicKey._meta.get_field("name").max_length
+        if name and len(name) > max_length:
+            return f"Name longer than {max_length} characters"
+
+    @staticmethod
+    def validate(key):
+        models.PublicKey._meta.get_field("key").run_validators(key)
+        return models.PublicKey.parse(key)
+
+    @action(
+        detail=False, methods=["post"], permission_classes=(permissions.IsAdminUser,)
+    )
+    def bulk(self, request):
+        """
+        Import public keys for many users at once.
+
+        Keys are validated in parallel and inserted with a single
+        `bulk_create`. Invalid lines are reported with their line number and
+        a single user sync is scheduled for all affected hosts. Only staff
+        users may import keys as they can be added for any user.
+        """
+        errors = []
+        entries = []
+        for line, entry in self.entries(request.data):
+            error = self.check(entry)
+            if error:
+                errors.append({"line": line, "error": error})
+                continue
+            entries.append((line, entry))
+        users = models.User.resolve(e.get("username") for _, e in entries)
+        max_length = models.PublicKey._meta.get_field("name").max_length
+        with ThreadPoolExecutor(settings.SALT_PUBLICKEY_IMPORT_WORKERS) as executor:
+            futures = [
+                (line, entry, executor.submit(self.validate, entry.get("key")))
+                for line, entry in entries
+            ]
+            keys = []
+            for line, entry, future in futures:
+                user = users.get(entry.get("username"))
+                if not user:
+                    errors.append({"line": line, "error": "Unknown user"})
+                    continue
+                try:
+                    fingerprint, openssh, comment = future.result()
+                except ValidationError as e:
+                    errors.append({"line": line, "error": " ".join(e.messages)})
+                    continue
+                except (TypeError, ValueError) as e:
+                    errors.append({"line": line, "error": str(e)})
+                    continue
+                keys.append(
+                    models.PublicKey(
+                        user=user,
+                        name=entry.get("name") or (comment or fingerprint)[:max_length],
+                        key=entry.get("key"),
+                        fingerprint=fingerprint,
+                        openssh=openssh,
+                        comment=comment,
+                    )
+                )
+        with transaction.atomic():
+            models.PublicKey.objects.bulk_create(keys)
+            affected = {k.user_id for k in keys}
+            if affected:
+                hosts = (
+                    models.Host.objects.filter(system__systemuser__user__in=affected)
+                    .values_list("name", flat=True)
+                    .distinct()
+                )
+                dispatcher.schedule("outpost.users", hosts)
+                models.System.touch(
+                    models.System.objects.filter(systemuser__user__in=affected)
+                )
+                models.Change.record_users("key", affected)
+        return Response(
+            {"created": len(keys), "errors": errors},
+            status=status.HTTP_201_CREATED if keys else status.HTTP_400_BAD_REQUEST,
+        )
+
+
+class ProvisionViewSet(viewsets.GenericViewSet):
+    """
+    Add a list of users to a system in bulk.
+    """
+
+    queryset = models.SystemUser.objects.all()
+    serializer_class = serializers.ProvisionSerializer
+    permission_classes = (permissions.IsAuthenticated, ExtendedDjangoModelPermissions)
+
+    def create(self, request):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = dict(serializer.validated_data)
+        created, unknown = models.SystemUser.provision(
+            data.pop("system"), data.pop("usernames"), data.pop("groups", ()), **data
+        )
+        return Response(
+            {"created": [su.user_id for su in created], "unknown": sorted(unknown)},
+            status=status.HTTP_201_CREATED,
+        )
+
+
+class StreamingListMixin(object):
+    """
+    Stream list responses as NDJSON and only load JSON columns on request.
+
+    Requests for the `ndjson` format are answered with a streaming response
+    which serializes objects while iterating the unpaginated queryset in
+    chunks. Fields listed in the `deferred` option of the serializer are
+    neither loaded nor rendered unless named in the `expand` parameter.
+    """
+
+    renderer_classes = tuple(api_settings.DEFAULT_RENDERER_CLASSES) + (
+        renderers.NDJSONRenderer,
+    )
+
+    def get_expand(self):
+        expand = self.request.query_params.get("expand", "")
+        return set(filter(None, expand.split(",")))
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context["expand"] = self.get_expand()
+        return context
+
+    def get_queryset(self):
+        qs = super().get_queryset()
+        deferred = self.get_serializer_class().Meta.deferred
+        return qs.defer(*(set(deferred) - self.get_expand()))
+
+    def list(self, request, *args, **kwargs):
+        if request.accepted_renderer.format != renderers.NDJSONRenderer.format:
+            return super().list(request, *args, **kwargs)
+        qs = self.filter_queryset(self.get_queryset())
+        serializer_class = self.get_serializer_class()
+        context = self.get_serializer_context()
+        lines = (
+            renderers.NDJSONRenderer.line(serializer_class(o, context=context).data)
+            for o in qs.iterator(chunk_size=settings.SALT_API_STREAM_CHUNK_SIZE)
+        )
+        return StreamingHttpResponse(
+            lines, content_type=renderers.NDJSONRenderer.media_type
+        )
+
+
+class JobViewSet(StreamingListMixin, viewsets.ReadOnlyModelViewSet):
+    """
+    Salt jobs, filterable by `jid` and by `target`, `function` and `success`
+    of their results.
+    """
+
+    queryset = models.Job.objects.all()
+    serializer_class = serializers.JobSerializer
+    permission_classes = (permissions.IsAuthenticated, ExtendedDjangoModelPermissions)
+
+    def get_queryset(self):
+        qs = super().get_queryset().order_by("-pk")
+        params = self.request.query_params
+        if "jid" in params:
+            qs = qs.filter(pk=params.get("jid"))
+        filters = ResultViewSet.filters(params, prefix="result__")
+        if filters:
+            qs = qs.filter(**filters).distinct()
+        return qs
+
+
+class ResultViewSet(StreamingListMixin, viewsets.ReadOnlyModelViewSet):
+    """
+    Returns of Salt jobs per host, filterable by `jid`, `target`, `function`
+    and `success`.
+    """
+
+    queryset = models.Result.objects.all()
+    serializer_class = serializers.ResultSerializer
+    permission_classes = (permissions.IsAuthenticated, ExtendedDjangoModelPermissions)
+
+    @staticmethod
+    def filters(params, prefix=""):
+        filters = dict()
+        for param, lookup in (("target", "target"), ("function", "function")):
+            if param in params:
+                filters[f"{prefix}{lookup}"] = params.get(param)
+        if "success" in params:
+            success = params.get("success").lower() in ("1", "true", "yes")
+            filters[f"{prefix}success"] = success
+        return filters
+
+    def get_queryset(self):
+        qs = super().get_queryset()
+        params = self.request.query_params
+        if "jid" in params:
+            qs = qs.filter(job_id=params.get("jid"))
+        return qs.filter(**self.filters(params))
+
 
 class AuthenticateViewSet(viewsets.ViewSet):
     permission_classes = (permissions.AllowAny,)
@@ -62,10 +366,9 @@ class AuthenticateViewSet(viewsets.ViewSet):
         user = authenticate(request, username=username, password=password)
         if not user:
             raise exceptions.AuthenticationFailed()
-        perms = defaultdict(list)
-        for p in models.Permission.objects.filter(user=user):
-            for h in p.system.host_set.all():
-                perms[h.name].append(p.function)
-        eauth = perms.get(None, [])
-        eauth.extend([{k: v} for k, v in perms.items() if k])
+        key = models.Permission.cache_key(user)
+        eauth = cache.get(key)
+        if eauth is None:
+            eauth = models.Permission.eauth(user)
+            cache.set(key, eauth, settings.SALT_EAUTH_CACHE_TIMEOUT)
         return Response(eauth)
@@ -0,0 +1,107 @@
+import logging
+import os
+import threading
+import time
+
+import requests
+from purl import URL
+from requests.adapters import HTTPAdapter
+
+from .conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class SaltClient:
+    """
+    Client for the Salt API using a pooled session and token authentication.
+
+    The client logs in once through `/login` and reuses the token for all
+    requests until it is about to expire. A request rejected with `401` causes
+    a fresh login and is retried once. Use `SaltClient.instance()` to get the
+    client shared by all threads of the current process.
+    """
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self, url, username, password, eauth="rest"):
+        self.url = URL(url)
+        self.username = username
+        self.password = password
+        self.eauth = eauth
+        self.token = None
+        self.expire = 0
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        self.session.headers.update({"Accept": "application/json"})
+        adapter = HTTPAdapter(pool_maxsize=settings.SALT_CLIENT_POOL_SIZE)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @classmethod
+    def instance(cls):
+        with cls._lock:
+            # Sessions must not be shared with forked worker processes.
+            if cls._instance is None or cls._instance.pid != os.getpid():
+                cls._instance = cls(
+                    settings.SALT_MANAGEMENT_URL,
+                    settings.SALT_MANAGEMENT_USER,
+                    settings.SALT_MANAGEMENT_PASSWORD,
+                )
+                cls._instance.pid = os.getpid()
+            return cls._instance
+
+    def login(self):
+        data = {
+            "username": self.username,
+            "password": self.password,
+            "eauth": self.eauth,
+        }
+        url = self.url.add_path_segment("login").as_string()
+        logger.debug(f"Fetching new token from {url}")
+        response = self.session.post(
+            url, json=data, timeout=settings.SALT_CLIENT_TIMEOUT
+        )
+        response.raise_for_status()
+        returned = next(iter(response.json().get("return")))
+        lifetime = returned.get("expire") - returned.get("start")
+        with self.lock:
+            self.token = returned.get("token")
+            self.expire = time.monotonic() + lifetime
+        return returned
+
+    def authenticate(self):
+        with self.lock:
+            margin = settings.SALT_CLIENT_TOKEN_MARGIN
+            if self.token and time.monotonic() < self.expire - margin:
+                return self.token
+        return self.login().get("token")
+
+    def request(self, method, *segments, **kwargs):
+        url = self.url
+        for segment in segments:
+            url = url.add_path_segment(segment)
+        kwargs.setdefault("timeout", settings.SALT_CLIENT_TIMEOUT)
+        for retry in (True, False):
+            headers = {"X-Auth-Token": self.authenticate()}
+            response = self.session.request(
+                method, url.as_string(), headers=headers, **kwargs
+            )
+            if response.status_code == 401 and retry:
+                logger.debug("Token was rejected by Salt API, logging in again")
+                with self.lock:
+                    self.token = None
+                continue
+            response.raise_for_status()
+            return response.json()
+
+    def run(self, **lowstate):
+        return next(iter(self.run_batch([lowstate])))
+
+    def run_batch(self, lowstates):
+        chunks = [dict({"client": "local_async"}, **lowstate) for lowstate in lowstates]
+        return self.request("POST", json=chunks).get("return")
+
+    def lookup_jid(self, jid):
+        return self.request("GET", "jobs", jid)
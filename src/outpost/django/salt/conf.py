@@ -1,3 +1,5 @@
+from datetime import timedelta
+
 from appconf import AppConf
 from django.conf import settings
 
@@ -7,7 +9,38 @@ class SaltAppConf(AppConf):
     MANAGEMENT_USER = __package__
     MANAGEMENT_PASSWORD = None
     MANAGEMENT_PERMISSIONS = [".*"]
+    EAUTH_CACHE_TIMEOUT = 300
+    PILLAR_CACHE_TIMEOUT = 86400
+    API_STREAM_CHUNK_SIZE = 1000
+    CLIENT_POOL_SIZE = 10
+    PUBLICKEY_IMPORT_WORKERS = 4
+    CLIENT_TIMEOUT = 30
+    CLIENT_TOKEN_MARGIN = 60
     EVENTS_RETRY = 60
+    EVENTS_BACKOFF_MIN = 1
+    EVENTS_HEARTBEAT = 30
+    EVENTS_QUEUE_SIZE = 1000
+    EVENTS_QUEUE_POLICY = "block"
+    EVENTS_WORKERS = 4
+    EVENTS_ROUTES = dict()
+    EVENTS_STATS_INTERVAL = 60
+    EVENTS_INCLUDE = ["*"]
+    EVENTS_EXCLUDE = []
+    EVENTS_ORJSON = True
+    EVENTS_SINK = False
+    EVENTS_SINK_SIZE = 500
+    EVENTS_SINK_INTERVAL = 5
+    RESULT_PARTITIONED = False
+    RESULT_PARTITIONS_AHEAD = 2
+    RESULT_RETENTION = timedelta(days=180)
+    CHANGES_RETENTION = timedelta(days=30)
+    CLEANUP_INCREMENTAL = True
+    CLEANUP_FULL_INTERVAL = timedelta(hours=1)
+    DISPATCH_DEBOUNCE = 10
+    DISPATCH_RETENTION = timedelta(days=30)
+    TARGET_GRAIN = "host"
+    TARGET_CHUNK_SIZE = 100
+    TARGET_BATCH = None
     PUBLIC_KEY = """
 -----BEGIN PGP PUBLIC KEY BLOCK-----
 
@@ -0,0 +1,190 @@
+import logging
+import threading
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import (
+    F,
+    Func,
+    Value,
+)
+
+from .conf import settings
+from .tasks import (
+    CommandTasks,
+    SystemTasks,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Batch(defaultdict):
+    """
+    Requested states per host, registered as `on_commit` callback.
+    """
+
+    def __init__(self, dispatcher):
+        super().__init__(set)
+        self.dispatcher = dispatcher
+        self.origins = defaultdict(set)
+
+    def __call__(self):
+        self.dispatcher.flush(self)
+
+
+class Dispatcher:
+    """
+    Coalesce `state.apply` calls per transaction into debounced jobs.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+
+    @staticmethod
+    def subsumes(state, other):
+        return other == state or other.startswith(f"{state}.")
+
+    @staticmethod
+    def key(state, host):
+        return f"{__name__}:{state}:{host}"
+
+    @classmethod
+    def reduce(cls, states):
+        return {
+            s for s in states if not any(o != s and cls.subsumes(o, s) for o in states)
+        }
+
+    @staticmethod
+    def origin(instance):
+        return f"{instance._meta.label}:{instance.pk}"
+
+    def schedule(self, state, hosts, origin=None):
+        hosts = set(hosts)
+        if not hosts:
+            return
+        origin = self.origin(origin) if origin is not None else None
+        connection = transaction.get_connection()
+        if not connection.in_atomic_block:
+            self.dispatch(state, hosts, {origin} - {None})
+            return
+        batch = getattr(self.local, "batch", None)
+        if batch is None or not any(
+            entry[1] is batch for entry in connection.run_on_commit
+        ):
+            batch = self.local.batch = Batch(self)
+            transaction.on_commit(batch)
+        for host in hosts:
+            batch[host].add(state)
+        if origin:
+            batch.origins[state].add(origin)
+
+    def flush(self, batch):
+        if getattr(self.local, "batch", None) is batch:
+            self.local.batch = None
+        states = defaultdict(set)
+        for host, requested in batch.items():
+            for state in self.reduce(requested):
+                states[state].add(host)
+        for state, hosts in states.items():
+            origins = set()
+            for requested, o in batch.origins.items():
+                if self.subsumes(state, requested):
+                    origins.update(o)
+            self.dispatch(state, hosts, origins)
+
+    def dispatch(self, state, hosts, origins):
+        from .models import Dispatch
+
+        delay = settings.SALT_DISPATCH_DEBOUNCE
+        origins = sorted(origins)
+        pending = set()
+        if delay:
+            parts = state.split(".")
+            covering = [".".join(parts[: i + 1]) for i in range(len(parts))]
+            keys = {h: [self.key(s, h) for s in covering] for h in hosts}
+            waiting = cache.get_many([k for v in keys.values() for k in v])
+            hosts = []
+            for host, k in keys.items():
+                # Broader states already waiting cover this one as well.
+                found = [waiting[c] for c in k if c in waiting]
+                if found:
+                    pending.update(found)
+                else:
+                    hosts.append(host)
+        dispatch = None
+        if hosts:
+            dispatch = Dispatch.objects.create(
+                state=state, hosts=sorted(hosts), origins=origins
+            )
+        if dispatch and delay:
+            accepted = []
+            for host in dispatch.hosts:
+                key = self.key(state, host)
+                if cache.add(key, dispatch.pk, delay):
+                    accepted.append(host)
+                else:
+                    pending.add(cache.get(key))
+            if not accepted:
+                dispatch.delete()
+                dispatch = None
+            elif accepted != dispatch.hosts:
+                dispatch.hosts = accepted
+                dispatch.save(update_fields=("hosts",))
+        if pending and origins:
+            Dispatch.objects.filter(pk__in=pending - {None}, sent=None).update(
+                origins=Func(F("origins"), Value(origins), function="array_cat")
+            )
+        if not dispatch:
+            logger.debug(f"State {state} already pending for all hosts")
+            return
+        task = CommandTasks().run.apply_async(
+            kwargs={
+                "hosts": dispatch.hosts,
+                "fun": "state.apply",
+                "arg": [state],
+                "dispatch": dispatch.pk,
+            },
+            countdown=delay,
+        )
+        logger.debug(f"Scheduled {dispatch} as {task.id}")
+
+
+class Systems(set):
+    def __init__(self, rebuilder):
+        super().__init__()
+        self.rebuilder = rebuilder
+
+    def __call__(self):
+        self.rebuilder.flush(self)
+
+
+class Rebuilder:
+    def __init__(self):
+        self.local = threading.local()
+
+    def schedule(self, systems):
+        systems = set(systems)
+        if not systems:
+            return
+        connection = transaction.get_connection()
+        if not connection.in_atomic_block:
+            SystemTasks().pillar.delay(sorted(systems))
+            return
+        batch = getattr(self.local, "batch", None)
+        if batch is None or not any(
+            entry[1] is batch for entry in connection.run_on_commit
+        ):
+            batch = self.local.batch = Systems(self)
+            transaction.on_commit(batch)
+        batch.update(systems)
+
+    def flush(self, batch):
+        if getattr(self.local, "batch", None) is batch:
+            self.local.batch = None
+        SystemTasks().pillar.delay(sorted(batch))
+        logger.debug(f"Scheduled pillar rebuild for systems {sorted(batch)}")
+
+
+dispatcher = Dispatcher()
+rebuilder = Rebuilder()
@@ -5,4 +5,7 @@ v1 = [
     (r"salt/host", api.HostViewSet, "salt-host"),
     (r"salt/file", api.FileViewSet, "salt-file"),
     (r"salt/publickey", api.PublicKeyViewSet, "salt-publickey"),
+    (r"salt/provision", api.ProvisionViewSet, "salt-provision"),
+    (r"salt/job", api.JobViewSet, "salt-job"),
+    (r"salt/result", api.ResultViewSet, "salt-result"),
 ]
@@ -0,0 +1,361 @@
+import asyncio
+import fnmatch
+import json
+import logging
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import (
+    datetime,
+    timezone,
+)
+
+from django.db import (
+    DatabaseError,
+    InterfaceError,
+    OperationalError,
+    close_old_connections,
+    transaction,
+)
+
+from .conf import settings
+from .signals import event
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+
+def compile_patterns(patterns):
+    """
+    Combine glob patterns on event tags into a single regular expression.
+    """
+    if not patterns:
+        return None
+    return re.compile("|".join(fnmatch.translate(p) for p in patterns))
+
+
+class Backoff:
+    """
+    Exponential backoff with full jitter.
+
+    Delays grow from `SALT_EVENTS_BACKOFF_MIN` up to `SALT_EVENTS_RETRY`
+    seconds with every consecutive failure until `reset()` is called.
+    """
+
+    def __init__(self):
+        self.failures = 0
+
+    def reset(self):
+        self.failures = 0
+
+    def delay(self):
+        ceiling = min(
+            settings.SALT_EVENTS_RETRY,
+            settings.SALT_EVENTS_BACKOFF_MIN * 2 ** self.failures,
+        )
+        self.failures += 1
+        return random.uniform(0, ceiling)
+
+    async def wait(self):
+        delay = self.delay()
+        logger.debug(f"Backing off for {delay:.1f}s after {self.failures} failures")
+        await asyncio.sleep(delay)
+
+
+class Decoder:
+    """
+    Decode frames from the Salt API websocket, skipping unwanted events early.
+
+    Salt API sends events as `data: {"data": ..., "tag": ...}`, so the tag can
+    be extracted from the end of a frame without decoding the whole payload.
+    Only events whose tag matches `SALT_EVENTS_INCLUDE` and does not match
+    `SALT_EVENTS_EXCLUDE` are decoded, using orjson if it is installed and
+    `SALT_EVENTS_ORJSON` is enabled.
+    """
+
+    suffix = re.compile(r', "tag": "(?P<tag>(?:[^"\\]|\\.)*)"\}\s*\Z')
+
+    def __init__(self):
+        self.include = compile_patterns(settings.SALT_EVENTS_INCLUDE)
+        self.exclude = compile_patterns(settings.SALT_EVENTS_EXCLUDE)
+        if orjson and settings.SALT_EVENTS_ORJSON:
+            self.loads = orjson.loads
+        else:
+            self.loads = json.loads
+        self.skipped = 0
+
+    def wanted(self, tag):
+        if self.include and not self.include.match(tag):
+            return False
+        return not (self.exclude and self.exclude.match(tag))
+
+    def decode(self, frame):
+        if not frame.startswith("data: "):
+            logger.debug(f"Ignoring frame: {frame[:64]}")
+            return None
+        match = self.suffix.search(frame)
+        if match and not self.wanted(match.group("tag")):
+            self.skipped += 1
+            return None
+        data = self.loads(frame[6:])
+        if not match and not self.wanted(data.get("tag", "")):
+            self.skipped += 1
+            return None
+        return data
+
+
+class Route:
+    """
+    Bounded queue and pool of workers for events whose tags match a route.
+
+    Workers hand events over to the receivers of `signals.event` in threads of
+    the shared executor. If the queue is full, new events either wait for free
+    space or are dropped, depending on `SALT_EVENTS_QUEUE_POLICY`.
+    """
+
+    def __init__(self, name, patterns, sender, executor):
+        self.name = name
+        self.pattern = compile_patterns(patterns)
+        self.sender = sender
+        self.executor = executor
+        self.queue = asyncio.Queue(maxsize=settings.SALT_EVENTS_QUEUE_SIZE)
+        self.workers = []
+        self.reset()
+
+    def reset(self):
+        self.dispatched = 0
+        self.dropped = 0
+        self.latency = 0.0
+
+    def matches(self, tag):
+        return self.pattern is None or self.pattern.match(tag)
+
+    def start(self, loop):
+        self.workers = [
+            loop.create_task(self.work(loop))
+            for _ in range(settings.SALT_EVENTS_WORKERS)
+        ]
+
+    async def put(self, data):
+        item = (time.monotonic(), data)
+        if settings.SALT_EVENTS_QUEUE_POLICY == "drop":
+            try:
+                self.queue.put_nowait(item)
+            except asyncio.QueueFull:
+                self.dropped += 1
+                logger.debug(f"Dropped event {data.get('tag')} on full {self.name}")
+            return
+        await self.queue.put(item)
+
+    def dispatch(self, data):
+        close_old_connections()
+        for receiver, response in event.send_robust(self.sender, data=data):
+            if isinstance(response, Exception):
+                logger.error(f"Receiver {receiver} failed on event: {response}")
+
+    async def work(self, loop):
+        while True:
+            received, data = await self.queue.get()
+            try:
+                await loop.run_in_executor(self.executor, self.dispatch, data)
+            finally:
+                self.queue.task_done()
+            self.dispatched += 1
+            self.latency += time.monotonic() - received
+
+    def stats(self):
+        latency = self.latency / self.dispatched if self.dispatched else 0.0
+        return (
+            f"{self.name}: depth={self.queue.qsize()} dispatched={self.dispatched} "
+            f"dropped={self.dropped} latency={latency:.3f}s"
+        )
+
+
+class ResultSink:
+    """
+    Persist job returns from the event bus into `Job` and `Result` in bulk.
+
+    New jobs and returns are buffered by `receive`, which is connected to
+    `signals.event`, and written with `bulk_create` once
+    `SALT_EVENTS_SINK_SIZE` returns are pending or `flush` is called by the
+    pipeline every `SALT_EVENTS_SINK_INTERVAL` seconds. Jobs whose `new` event
+    was not seen are stored with just their ID so returns can refer to them.
+    Returns not fitting the table are dropped on receipt. If a batch can not
+    be stored, it is kept for the next flush when the database is unavailable
+    and stored row by row otherwise.
+    """
+
+    new = re.compile(r"^salt/job/(?P<jid>\d+)/new$")
+    ret = re.compile(r"^salt/job/(?P<jid>\d+)/ret/(?P<minion>.+)$")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = dict()
+        self.results = []
+
+    def receive(self, sender, data, **kwargs):
+        from .models import Result
+
+        tag = data.get("tag", "")
+        payload = data.get("data", {})
+        match = self.new.match(tag)
+        if match:
+            with self.lock:
+                self.jobs[match.group("jid")] = payload
+            return
+        match = self.ret.match(tag)
+        if not match:
+            return
+        jid = match.group("jid")
+        function = payload.get("fun", "")
+        if len(jid) > 20 or len(function) > 50 or len(match.group("minion")) > 255:
+            logger.warning(f"Dropping return not fitting into results: {tag}")
+            return
+        stamp = payload.get("_stamp")
+        if stamp:
+            modified = datetime.fromisoformat(stamp).replace(tzinfo=timezone.utc)
+        else:
+            modified = datetime.now(timezone.utc)
+        result = payload.get("return")
+        result = Result(
+            function=function,
+            job_id=jid,
+            # The column can not hold None, the payload in data still does.
+            result={} if result is None else result,
+            data=payload,
+            target=match.group("minion"),
+            success=payload.get("success", payload.get("retcode") == 0),
+            modified=modified,
+        )
+        with self.lock:
+            self.jobs.setdefault(jid, {"jid": jid})
+            self.results.append(result)
+            pending = len(self.results)
+        if pending >= settings.SALT_EVENTS_SINK_SIZE:
+            self.flush()
+
+    def flush(self):
+        from .models import (
+            Job,
+            Result,
+        )
+
+        with self.lock:
+            jobs, self.jobs = self.jobs, dict()
+            results, self.results = self.results, []
+        if not jobs and not results:
+            return
+        close_old_connections()
+        jobs = [Job(id=jid, data=data) for jid, data in jobs.items()]
+        try:
+            with transaction.atomic():
+                Job.objects.bulk_create(jobs, ignore_conflicts=True)
+                Result.objects.bulk_create(results)
+        except (OperationalError, InterfaceError) as e:
+            logger.warning(f"Could not store job returns, keeping them: {e}")
+            with self.lock:
+                for job in jobs:
+                    self.jobs.setdefault(job.id, job.data)
+                self.results[:0] = results
+            return
+        except DatabaseError as e:
+            logger.warning(f"Could not store job returns in bulk: {e}")
+            self.store(jobs, results)
+            return
+        logger.debug(f"Stored {len(jobs)} jobs and {len(results)} results")
+
+    def store(self, jobs, results):
+        from .models import (
+            Job,
+            Result,
+        )
+
+        for job in jobs:
+            try:
+                with transaction.atomic():
+                    Job.objects.bulk_create([job], ignore_conflicts=True)
+            except DatabaseError as e:
+                logger.error(f"Dropping job {job.id}: {e}")
+        for result in results:
+            try:
+                with transaction.atomic():
+                    Result.objects.bulk_create([result])
+            except DatabaseError as e:
+                logger.error(f"Dropping return of {result.target}: {e}")
+
+
+class Pipeline:
+    """
+    Route events from the Salt event bus to bounded per-route queues.
+
+    Frames are decoded and filtered by a `Decoder`. Routes are taken from
+    `SALT_EVENTS_ROUTES`, a mapping of route names to glob patterns on event
+    tags. Each event goes to the first matching route, events matching none of
+    them go to the `default` route. If `SALT_EVENTS_SINK` is enabled, job
+    returns are also persisted by a `ResultSink`. Skipped events, queue depth,
+    dispatch counts and average latency are logged each
+    `SALT_EVENTS_STATS_INTERVAL` seconds.
+    """
+
+    def __init__(self, sender):
+        self.decoder = Decoder()
+        self.sink = ResultSink() if settings.SALT_EVENTS_SINK else None
+        routes = list(settings.SALT_EVENTS_ROUTES.items()) + [("default", None)]
+        self.executor = ThreadPoolExecutor(
+            max_workers=settings.SALT_EVENTS_WORKERS * len(routes)
+        )
+        self.routes = [
+            Route(name, patterns, sender, self.executor) for name, patterns in routes
+        ]
+        self.tasks = []
+
+    def start(self, loop):
+        for route in self.routes:
+            route.start(loop)
+        self.tasks = [loop.create_task(self.report())]
+        if self.sink:
+            event.connect(self.sink.receive, dispatch_uid=f"{__name__}.sink")
+            self.tasks.append(loop.create_task(self.store(loop)))
+
+    async def feed(self, frame):
+        data = self.decoder.decode(frame)
+        if data is not None:
+            await self.put(data)
+
+    async def put(self, data):
+        tag = data.get("tag", "")
+        route = next(r for r in self.routes if r.matches(tag))
+        await route.put(data)
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(settings.SALT_EVENTS_STATS_INTERVAL)
+            logger.info(f"skipped: {self.decoder.skipped}")
+            self.decoder.skipped = 0
+            for route in self.routes:
+                logger.info(route.stats())
+                route.reset()
+
+    async def store(self, loop):
+        while True:
+            await asyncio.sleep(settings.SALT_EVENTS_SINK_INTERVAL)
+            try:
+                await loop.run_in_executor(self.executor, self.sink.flush)
+            except Exception as e:
+                logger.error(f"Could not store job returns: {e}")
+
+    async def stop(self):
+        tasks = self.tasks + [w for r in self.routes for w in r.workers]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.executor.shutdown(wait=True)
+        if self.sink:
+            event.disconnect(dispatch_uid=f"{__name__}.sink")
+            self.sink.flush()
@@ -0,0 +1,42 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from ...models import PublicKey
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """
+    Store fingerprint, OpenSSH representation and comment of public keys
+    saved before these values were kept in their own columns.
+
+    Keys are parsed while being loaded, so each batch only has to be written
+    back with a single `bulk_update`.
+    """
+
+    help = "Fill derived columns of existing public keys."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        size = options["batch_size"]
+        fields = ("fingerprint", "openssh", "comment")
+        qs = PublicKey.objects.filter(fingerprint="").only("pk", "key", *fields)
+        batch = []
+        updated = 0
+        for key in qs.order_by("pk").iterator(chunk_size=size):
+            if not key.fingerprint:
+                logger.warning(f"Skipping unparsable public key {key.pk}")
+                continue
+            batch.append(key)
+            if len(batch) >= size:
+                PublicKey.objects.bulk_update(batch, fields)
+                updated += len(batch)
+                batch = []
+        if batch:
+            PublicKey.objects.bulk_update(batch, fields)
+            updated += len(batch)
+        self.stdout.write(f"Updated {updated} public keys")
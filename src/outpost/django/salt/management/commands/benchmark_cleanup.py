@@ -0,0 +1,68 @@
+import time
+
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.management.base import BaseCommand
+from django.db import (
+    connection,
+    transaction,
+)
+from django.test.utils import CaptureQueriesContext
+
+from ...models import (
+    ExternalUser,
+    StaffUser,
+    StudentUser,
+    User,
+)
+from ...tasks import UserTasks
+
+
+class Command(BaseCommand):
+    """
+    Compare the per-user person lookups formerly done by the cleanup task
+    with the anti-join and checksum based change detection on the current
+    database. All changes are rolled back.
+    """
+
+    help = "Benchmark change detection of the user cleanup task."
+
+    def measure(self, label, func):
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            changed = func()
+            duration = time.perf_counter() - start
+        self.stdout.write(
+            f"{label}: {len(changed)} changed, {len(context.captured_queries)} "
+            f"queries, {duration:.3f}s"
+        )
+
+    def lookups(self):
+        changed = []
+        for user in User.objects.all():
+            try:
+                str(user.person)
+            except ObjectDoesNotExist:
+                exists = False
+            else:
+                exists = True
+            if exists != user.active:
+                changed.append(user.pk)
+        return changed
+
+    def reconcile(self, incremental):
+        changed = []
+        with transaction.atomic():
+            for cls in (StaffUser, ExternalUser, StudentUser):
+                persons = None
+                if incremental:
+                    _, persons = UserTasks.changes(cls)
+                if persons is not None and not persons:
+                    continue
+                changed.extend(UserTasks.reconcile(cls, persons)[1])
+            transaction.set_rollback(True)
+        return changed
+
+    def handle(self, *args, **options):
+        self.measure("per-user lookups", self.lookups)
+        self.measure("anti-join", lambda: self.reconcile(False))
+        self.measure("checksum and anti-join", lambda: self.reconcile(True))
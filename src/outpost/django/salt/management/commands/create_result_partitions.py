@@ -0,0 +1,23 @@
+from django.core.management.base import (
+    BaseCommand,
+    CommandError,
+)
+from django.utils import timezone
+
+from ... import partitions
+from ...conf import settings
+
+
+class Command(BaseCommand):
+    """
+    Create the partitioned `salt_result` table and its upcoming partitions,
+    for installations enabling `SALT_RESULT_PARTITIONED` after migrating.
+    """
+
+    help = "Create partitioned tables for Salt job results."
+
+    def handle(self, *args, **options):
+        if not partitions.create():
+            raise CommandError("Table salt_result exists and is not partitioned")
+        partitions.extend(timezone.now().date(), settings.SALT_RESULT_PARTITIONS_AHEAD)
+        self.stdout.write("Created partitioned salt_result table")
@@ -0,0 +1,52 @@
+import logging
+
+from django.core.management.base import (
+    BaseCommand,
+    CommandError,
+)
+
+from ...models import (
+    Group,
+    System,
+    SystemUser,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """
+    Add users to a system in bulk, reading usernames from the command line or
+    from a file with one username per line.
+    """
+
+    help = "Provision users on a system."
+
+    def add_arguments(self, parser):
+        parser.add_argument("system", help="Name of the system")
+        parser.add_argument("usernames", nargs="*")
+        parser.add_argument("--file", help="File with one username per line")
+        parser.add_argument("--group", type=int, action="append", default=[])
+        parser.add_argument("--shell")
+        parser.add_argument("--sudo", action="store_true")
+
+    def handle(self, *args, **options):
+        try:
+            system = System.objects.get(name=options["system"])
+        except System.DoesNotExist:
+            raise CommandError(f"Unknown system {options['system']}")
+        usernames = set(options["usernames"])
+        if options["file"]:
+            with open(options["file"]) as f:
+                usernames.update(filter(None, (line.strip() for line in f)))
+        groups = list(Group.objects.filter(pk__in=options["group"]))
+        unknown = set(options["group"]) - {g.pk for g in groups}
+        if unknown:
+            raise CommandError(f"Unknown groups {sorted(unknown)}")
+        defaults = {"sudo": options["sudo"]}
+        if options["shell"]:
+            defaults["shell"] = options["shell"]
+        created, unknown = SystemUser.provision(system, usernames, groups, **defaults)
+        for username in sorted(unknown):
+            logger.warning(f"Unknown user {username}")
+        self.stdout.write(f"Added {len(created)} users to {system}")
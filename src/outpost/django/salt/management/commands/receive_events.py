@@ -1,96 +1,180 @@
 import asyncio
-import concurrent
-import json
+import enum
 import logging
-import re
+import signal
 import sys
+import time
 
 import aiohttp
+import requests
 from django.core.management.base import BaseCommand
 from purl import URL
 
+from ...client import SaltClient
 from ...conf import settings
-from ...signals import event
+from ...events import (
+    Backoff,
+    Pipeline,
+)
 
 logger = logging.getLogger(__name__)
 
 
+class State(enum.Enum):
+    AUTHENTICATE = "authenticate"
+    CONNECT = "connect"
+    BACKOFF = "backoff"
+
+
 class Command(BaseCommand):
+    """
+    Listen on the Salt API websocket and dispatch events through a pipeline.
+
+    The listener is a state machine: it authenticates, connects and streams
+    until the connection breaks, then reconnects right away with the current
+    token. Failed logins, failed connection attempts and connections closed
+    before delivering any event back off exponentially with jitter and a
+    rejected token causes a new login. A background task renews
+    the token `SALT_CLIENT_TOKEN_MARGIN` seconds before it expires, so
+    reconnects never have to wait for a login. On SIGINT or SIGTERM the
+    pipeline is stopped and buffered job returns are stored.
+    """
+
     help = "Watch for events on the Saltstack bus."
-    token = None
-    token_event = asyncio.Event()
-    loop = asyncio.get_event_loop()
     url = URL(settings.SALT_MANAGEMENT_URL)
+    client = SaltClient.instance()
 
     def add_arguments(self, parser):
         pass
 
-    async def get_token(self, session):
-        data = {
-            "username": settings.SALT_MANAGEMENT_USER,
-            "password": settings.SALT_MANAGEMENT_PASSWORD,
-            "eauth": "rest",
-        }
-        headers = {"content-type": "application/json"}
-        url = self.url.add_path_segment("login").as_string()
-        logger.debug(f"Fetching new token from {url}")
-        async with session.post(url, json=data, headers=headers) as response:
+    async def authenticate(self):
+        logger.debug("Fetching new token")
+        returned = await self.loop.run_in_executor(None, self.client.login)
+        self.token = returned.get("token")
+        self.expire = time.monotonic() + returned.get("expire") - returned.get("start")
+        logger.debug("Got new token")
+
+    async def refresh(self):
+        backoff = Backoff()
+        while True:
+            margin = settings.SALT_CLIENT_TOKEN_MARGIN
+            await asyncio.sleep(max(self.expire - margin - time.monotonic(), 0))
             try:
-                response.raise_for_status()
-            except aiohttp.ClientResponseError as e:
-                logger.warn(f"Could not fetch new token: {e}")
-                self.token_event.clear()
-                self.token = None
-                self.loop.call_later(
-                    settings.SALT_EVENTS_RETRY, self.get_token, (session,)
-                )
-                return
-            response = await response.json()
-            returned = next(response.get("return").__iter__())
-            self.token = returned.get("token")
-            logger.debug(f"Got new token: {self.token}")
-            if not self.token_event.is_set():
-                logger.debug("Setting token event")
-                self.token_event.set()
-            lifetime = returned.get("expire") - returned.get("start")
-            self.loop.call_later(lifetime - 60, self.get_token, (session,))
+                await self.authenticate()
+            except asyncio.CancelledError:
+                raise
+            except requests.RequestException as e:
+                logger.warning(f"Could not refresh token: {e}")
+                await backoff.wait()
+            except Exception:
+                logger.exception("Unexpected error while refreshing token")
+                await backoff.wait()
+            else:
+                backoff.reset()
 
-    async def run(self):
-        pattern = re.compile(r"^(?P<type>\w+): (?P<data>.*)$")
+    async def stream(self, session):
         url = self.url.add_path_segment("ws").as_string()
-        async with aiohttp.ClientSession() as session:
-            await self.get_token(session)
-            while True:
-                logger.debug("Waiting for token")
-                await self.token_event.wait()
+        headers = {"X-Auth-Token": self.token}
+        async with session.ws_connect(
+            url, headers=headers, heartbeat=settings.SALT_EVENTS_HEARTBEAT
+        ) as stream:
+            await stream.send_str("websocket client ready")
+            self.health["connects"] += 1
+            if self.health["disconnected"]:
+                gap = time.monotonic() - self.health["disconnected"]
+                logger.info(f"Resumed event stream after {gap:.1f}s")
+            received = 0
+            async for message in stream:
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    logger.debug(f"Ignoring message: {message}")
+                    continue
+                if not received:
+                    self.backoff.reset()
+                received += 1
+                self.health["events"] += 1
+                try:
+                    await self.pipeline.feed(message.data)
+                except ValueError as e:
+                    logger.warning(f"Could not decode event: {e}")
+        self.health["disconnected"] = time.monotonic()
+        return received
+
+    async def run(self):
+        self.token = None
+        self.expire = 0
+        self.backoff = Backoff()
+        self.health = {"connects": 0, "failures": 0, "events": 0, "disconnected": 0}
+        self.pipeline = Pipeline(self.__class__)
+        self.pipeline.start(self.loop)
+        self.refresher = None
+        try:
+            async with aiohttp.ClientSession() as session:
+                await self.listen(session)
+        finally:
+            # Flush buffered job returns before exiting.
+            if self.refresher:
+                self.refresher.cancel()
+            await self.pipeline.stop()
+
+    async def listen(self, session):
+        state = State.AUTHENTICATE
+        while True:
+            logger.debug(f"Entering state {state.value}: {self.health}")
+            if state is State.BACKOFF:
+                await self.backoff.wait()
+                state = State.AUTHENTICATE if not self.token else State.CONNECT
+            elif state is State.AUTHENTICATE:
+                try:
+                    await self.authenticate()
+                except asyncio.CancelledError:
+                    raise
+                except requests.RequestException as e:
+                    logger.warning(f"Could not fetch new token: {e}")
+                    self.health["failures"] += 1
+                    state = State.BACKOFF
+                    continue
+                except Exception:
+                    logger.exception("Unexpected error while fetching token")
+                    self.health["failures"] += 1
+                    state = State.BACKOFF
+                    continue
+                if not self.refresher:
+                    self.refresher = self.loop.create_task(self.refresh())
+                state = State.CONNECT
+            elif state is State.CONNECT:
                 try:
-                    headers = {"X-Auth-Token": self.token}
-                    async with session.ws_connect(url, headers=headers) as stream:
-                        await stream.send_str("websocket client ready")
-                        while not stream.closed:
-                            raw = await stream.receive()
-                            matches = pattern.match(raw.decode("utf-8"))
-                            if not matches:
-                                logger.debug(f"Pattern does not match: {raw}")
-                                continue
-                            groups = matches.groupdict()
-                            t = groups.get("type")
-                            logger.debug(f"Received message of type {t}")
-                            if t == "data":
-                                data = json.loads(matches.groupdict().get("data"))
-                                self.loop.create_task(
-                                    self.loop.run_in_executor(
-                                        None, event.send_robust, self.__class__, data
-                                    )
-                                )
-                except (
-                    aiohttp.client_exceptions.ClientPayloadError,
-                    concurrent.futures._base.TimeoutError,
-                ):
-                    pass
+                    received = await self.stream(session)
+                except aiohttp.WSServerHandshakeError as e:
+                    logger.warning(f"Websocket handshake failed: {e}")
+                    self.health["failures"] += 1
+                    if e.status == 401:
+                        self.token = None
+                    state = State.BACKOFF
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    logger.warning(f"Event stream interrupted: {e}")
+                    self.health["failures"] += 1
+                    self.health["disconnected"] = time.monotonic()
+                    state = State.BACKOFF
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception("Unexpected error on event stream")
+                    self.health["failures"] += 1
+                    self.health["disconnected"] = time.monotonic()
+                    state = State.BACKOFF
+                else:
+                    logger.info(f"Event stream closed after {received} events")
+                    if not received:
+                        state = State.BACKOFF
 
     def handle(self, *args, **options):
+        self.loop = asyncio.get_event_loop()
+        main = self.loop.create_task(self.run())
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(signum, main.cancel)
         try:
-            self.loop.run_until_complete(self.run())
+            self.loop.run_until_complete(main)
+        except asyncio.CancelledError:
+            logger.info("Stopped listening for events")
         except OSError as exc:
             sys.exit("Error starting server: " + str(exc))
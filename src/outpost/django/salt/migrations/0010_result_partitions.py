@@ -0,0 +1,29 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:00
+
+from django.db import migrations
+
+
+def create_partitions(apps, schema_editor):
+    from django.utils import timezone
+    from outpost.django.salt import partitions
+    from outpost.django.salt.conf import settings
+
+    if not settings.SALT_RESULT_PARTITIONED:
+        return
+    if partitions.create(schema_editor.connection):
+        partitions.extend(
+            timezone.now().date(),
+            settings.SALT_RESULT_PARTITIONS_AHEAD,
+            schema_editor.connection,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("salt", "0009_userdirectory"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_partitions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,102 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:00
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("salt", "0010_result_partitions"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Dispatch",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("state", models.CharField(max_length=128)),
+                (
+                    "hosts",
+                    django.contrib.postgres.fields.ArrayField(
+                        base_field=models.CharField(max_length=64), size=None
+                    ),
+                ),
+                (
+                    "origins",
+                    django.contrib.postgres.fields.ArrayField(
+                        base_field=models.TextField(),
+                        blank=True,
+                        default=list,
+                        size=None,
+                    ),
+                ),
+                (
+                    "jids",
+                    django.contrib.postgres.fields.ArrayField(
+                        base_field=models.CharField(max_length=20),
+                        blank=True,
+                        default=list,
+                        size=None,
+                    ),
+                ),
+                (
+                    "minions",
+                    django.contrib.postgres.fields.ArrayField(
+                        base_field=models.TextField(),
+                        blank=True,
+                        default=list,
+                        size=None,
+                    ),
+                ),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                ("sent", models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                "ordering": ("-created",),
+            },
+        ),
+        migrations.CreateModel(
+            name="DispatchReturn",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("minion", models.TextField()),
+                ("success", models.BooleanField()),
+                ("received", models.DateTimeField(auto_now_add=True)),
+                (
+                    "dispatch",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="salt.Dispatch",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("dispatch", "minion")},
+            },
+        ),
+        migrations.AddIndex(
+            model_name="dispatch",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["jids"], name="salt_dispatch_jids"
+            ),
+        ),
+    ]
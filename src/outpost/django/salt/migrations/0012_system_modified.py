@@ -0,0 +1,22 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("salt", "0011_dispatch"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="system",
+            name="modified",
+            field=models.DateTimeField(
+                auto_now=True, default=django.utils.timezone.now
+            ),
+            preserve_default=False,
+        ),
+    ]
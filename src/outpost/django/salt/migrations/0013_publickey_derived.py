@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("salt", "0012_system_modified"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="publickey",
+            name="fingerprint",
+            field=models.CharField(blank=True, editable=False, max_length=128),
+        ),
+        migrations.AddField(
+            model_name="publickey",
+            name="openssh",
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name="publickey",
+            name="comment",
+            field=models.TextField(blank=True, editable=False),
+        ),
+    ]
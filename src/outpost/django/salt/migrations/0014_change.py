@@ -0,0 +1,46 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("salt", "0013_publickey_derived"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Change",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("kind", models.CharField(max_length=16)),
+                ("reference", models.TextField()),
+                ("action", models.CharField(max_length=8)),
+                ("txid", models.BigIntegerField()),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                (
+                    "system",
+                    models.ForeignKey(
+                        db_constraint=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="salt.System",
+                    ),
+                ),
+            ],
+            options={"ordering": ("pk",)},
+        ),
+        migrations.AddIndex(
+            model_name="change",
+            index=models.Index(fields=["system", "txid"], name="salt_change_system"),
+        ),
+    ]
@@ -3,29 +3,51 @@
 import hashlib
 import logging
 from base64 import b64encode
+from collections import defaultdict
+from datetime import timedelta
+from functools import lru_cache
 from hashlib import sha256
 from io import BytesIO
 from pathlib import PurePath
 from tempfile import NamedTemporaryFile
+from uuid import uuid4
 
 import asyncssh
 import django
 import magic
 from django.contrib.auth import get_user_model
 from django.contrib.auth.signals import user_logged_in
-from django.contrib.postgres.fields import JSONField
+from django.contrib.postgres.fields import (
+    ArrayField,
+    JSONField,
+)
+from django.contrib.postgres.indexes import GinIndex
+from django.core.cache import cache
 from django.core.exceptions import (
     ImproperlyConfigured,
+    ObjectDoesNotExist,
     ValidationError,
 )
 from django.core.files import File as DjangoFile
-from django.core.files.uploadedfile import TemporaryUploadedFile
 from django.core.validators import RegexValidator
-from django.db import models
+from django.db import (
+    connection,
+    models,
+    transaction,
+)
+from django.db.models import (
+    Func,
+    prefetch_related_objects,
+)
+from django.db.models.functions import Now
 from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
     post_save,
+    pre_delete,
     pre_save,
 )
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from outpost.django.base.decorators import signal_connect
 from outpost.django.base.utils import Uuid4Upload
@@ -42,7 +64,15 @@ from outpost.django.campusonline.models import (
 from polymorphic.models import PolymorphicModel
 
 from .conf import settings
-from .tasks import CommandTasks
+from .dispatch import (
+    dispatcher,
+    rebuilder,
+)
+from .signals import event
+from .storage import (
+    ContentAddressedStorage,
+    lock,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -70,10 +100,20 @@ class File(models.Model):
     )
     mimetype = models.TextField()
 
+    def save(self, *args, **kwargs):
+        # Keep the lock taken when storing content until the row is committed.
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
     @classmethod
     def pre_save_handler(cls, sender, instance, raw, *args, **kwargs):
         if raw:
             return
+        instance.previous_path = instance.previous_content = None
+        if instance.pk:
+            previous = cls.objects.filter(pk=instance.pk).values_list("path", "content")
+            for path, content in previous:
+                instance.previous_path, instance.previous_content = path, content
         for system in instance.user.systems.all():
             home = PurePath(
                 system.home_template.format(username=instance.user.username)
@@ -83,17 +123,21 @@ class File(models.Model):
                 raise ValidationError(
                     f"Path does not fit in home directory {home} on {system}."
                 )
-        if not isinstance(instance.content.file, TemporaryUploadedFile):
+        if not instance.content or instance.content._committed:
             return
-        hash = hashlib.sha256()
-        b = bytearray(128 * 1024)
-        mv = memoryview(b)
-        for n in iter(lambda: instance.content.readinto(mv), 0):
-            hash.update(mv[:n])
-        instance.sha256 = hash.hexdigest()
-        instance.content.seek(0)
-        mimetype = magic.detect_from_fobj(instance.content)
-        instance.mimetype = mimetype.mime_type
+        file = instance.content.file
+        if not hasattr(file, "sha256"):
+            # Files not received through .uploadhandlers are hashed in one pass.
+            hash = hashlib.sha256()
+            mimetype = None
+            for chunk in file.chunks():
+                if mimetype is None:
+                    mimetype = magic.detect_from_content(chunk).mime_type
+                hash.update(chunk)
+            file.sha256 = hash.hexdigest()
+            file.mimetype = mimetype or magic.detect_from_content(b"").mime_type
+        instance.sha256 = file.sha256
+        instance.mimetype = file.mimetype
         # with gpg.Context(armor=True) as c:
         #    imp = c.key_import(settings.SALT_PUBLIC_KEY.encode('ascii'))
         #    if not isinstance(imp, gpg.results.ImportResult):
@@ -119,15 +163,42 @@ class File(models.Model):
     def post_save_handler(cls, sender, instance, raw, *args, **kwargs):
         if raw:
             return
-        for system in instance.systems.all():
-            for host in system.host_set.all():
-                task = CommandTasks().run.delay(
-                    tgt_type="compound",
-                    tgt=f"G@host:{host.name}",
-                    fun="state.apply",
-                    arg=["outpost.files"],
-                )
-                logger.debug(f"Scheduled file sync for {host} as {task.id}")
+        hosts = Host.objects.filter(
+            system__in=instance.systems.all()
+        ).values_list("name", flat=True)
+        dispatcher.schedule("outpost.files", hosts, instance)
+        logger.debug(f"Scheduled file sync for {instance}")
+        previous = getattr(instance, "previous_content", None)
+        if previous and previous != instance.content.name:
+            cls.collect(instance.content.storage, previous)
+
+    @classmethod
+    def post_delete_handler(cls, sender, instance, *args, **kwargs):
+        cls.collect(instance.content.storage, instance.content.name)
+
+    @classmethod
+    def collect(cls, storage, name):
+        if not isinstance(storage, ContentAddressedStorage):
+            return
+
+        def collect():
+            with transaction.atomic():
+                lock(name)
+                if cls.objects.filter(content=name).exists():
+                    return
+                logger.debug(f"Removing unreferenced blob {name}")
+                storage.delete(name)
+
+        transaction.on_commit(collect)
+
+    @classmethod
+    def touch(cls, sender, instance, *args, **kwargs):
+        System.touch(instance.systems.all())
+        systemfiles = instance.systemfile_set.select_related("system")
+        previous = getattr(instance, "previous_path", None)
+        if previous and previous != instance.path:
+            Change.record_files(systemfiles, Change.DELETED, path=previous)
+        Change.record_files(systemfiles)
 
     def __str__(self):
         return f"{self.user}: {self.path}"
@@ -135,6 +206,8 @@ class File(models.Model):
 
 pre_save.connect(File.pre_save_handler, sender=File)
 post_save.connect(File.post_save_handler, sender=File)
+post_delete.connect(File.post_delete_handler, sender=File)
+post_save.connect(File.touch, sender=File)
 
 
 class SystemFile(models.Model):
@@ -143,70 +216,97 @@ class SystemFile(models.Model):
 
     @property
     def path(self) -> str:
+        return self.resolve(self.file.path)
+
+    def resolve(self, path) -> str:
         username = self.file.user.username
         home = PurePath(self.system.home_template.format(username=username))
-        path = home.joinpath(PurePath(self.file.path))
-        return str(path)
+        return str(home.joinpath(PurePath(path)))
 
     @classmethod
     def post_save_handler(cls, sender, instance, raw, *args, **kwargs):
         if raw:
             return
-        for host in instance.system.host_set.all():
-            task = CommandTasks().run.delay(
-                tgt_type="compound",
-                tgt=f"G@host:{host.name}",
-                fun="state.apply",
-                arg=["outpost.files"],
-            )
-            logger.debug(f"Scheduled file sync for {host} as {task.id}")
+        hosts = instance.system.host_set.values_list("name", flat=True)
+        dispatcher.schedule("outpost.files", hosts, instance)
+        logger.debug(f"Scheduled file sync for {instance}")
+
+    @classmethod
+    def touch(cls, sender, instance, *args, **kwargs):
+        System.touch([instance.system_id])
+        Change.record_files([instance], Change.action_of(**kwargs))
 
     def __str__(self):
         return f"{self.system}: {self.path}"
 
 
 post_save.connect(SystemFile.post_save_handler, sender=SystemFile)
+post_save.connect(SystemFile.touch, sender=SystemFile)
+post_delete.connect(SystemFile.touch, sender=SystemFile)
 
 
 class PublicKey(models.Model):
     user = models.ForeignKey("User", on_delete=models.CASCADE)
     name = models.CharField(max_length=128)
     key = models.TextField(validators=(PublicKeyValidator(),))
+    fingerprint = models.CharField(max_length=128, blank=True, editable=False)
+    openssh = models.TextField(blank=True, editable=False)
+    comment = models.TextField(blank=True, editable=False)
 
     def __str__(self):
         return self.name
 
-    @property
-    def fingerprint(self):
-        k = asyncssh.import_public_key(self.key)
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def parse(key):
+        """
+        Import a public key once and return its fingerprint, its OpenSSH
+        representation and its comment.
+        """
+        k = asyncssh.import_public_key(key)
         d = sha256(k.encode_ssh_public()).digest()
         f = b64encode(d).replace(b"=", b"").decode("utf-8")
-        return "SHA256:{}".format(f)
+        openssh = k.export_public_key().decode("utf-8")
+        return "SHA256:{}".format(f), openssh, k.get_comment() or ""
 
-    @property
-    def openssh(self):
-        k = asyncssh.import_public_key(self.key)
-        return k.export_public_key()
+    def derive(self):
+        self.fingerprint, self.openssh, self.comment = self.parse(self.key)
 
-    @property
-    def comment(self):
-        k = asyncssh.import_public_key(self.key)
-        return k.get_comment()
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        loaded = instance.__dict__
+        if "key" in loaded and "fingerprint" in loaded and not instance.fingerprint:
+            try:
+                instance.derive()
+            except (asyncssh.KeyImportError, ValueError) as e:
+                logger.warning(f"Could not parse public key {instance.pk}: {e}")
+        return instance
+
+    @classmethod
+    def pre_save(cls, sender, instance, raw, *args, **kwargs):
+        if raw:
+            return
+        instance.derive()
 
     @classmethod
     def post_save(cls, sender, instance, created, *args, **kwargs):
-        for system in instance.user.systems.all():
-            for host in system.host_set.all():
-                task = CommandTasks().run.delay(
-                    tgt_type="compound",
-                    tgt=f"G@host:{host.name}",
-                    fun="state.apply",
-                    arg=["outpost.users"],
-                )
-                logger.debug(f"Scheduled public key sync for {host} as {task.id}")
+        hosts = Host.objects.filter(
+            system__in=instance.user.systems.all()
+        ).values_list("name", flat=True)
+        dispatcher.schedule("outpost.users", hosts, instance)
+        logger.debug(f"Scheduled public key sync for {instance}")
+
+    @classmethod
+    def touch(cls, sender, instance, *args, **kwargs):
+        System.touch(System.objects.filter(systemuser__user_id=instance.user_id))
+        Change.record_users("key", [instance.user_id])
 
 
+pre_save.connect(PublicKey.pre_save, sender=PublicKey)
 post_save.connect(PublicKey.post_save, sender=PublicKey)
+post_save.connect(PublicKey.touch, sender=PublicKey)
+post_delete.connect(PublicKey.touch, sender=PublicKey)
 
 
 class System(models.Model):
@@ -214,6 +314,7 @@ class System(models.Model):
     home_template = models.CharField(max_length=256, default="/home/{username}")
     same_group_id = models.BooleanField(default=True)
     same_group_name = models.BooleanField(default=True)
+    modified = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ("name",)
@@ -221,16 +322,32 @@ class System(models.Model):
     def __str__(self):
         return self.name
 
+    @classmethod
+    def touch(cls, systems):
+        """
+        Bump the modification time of systems whose pillar data changed.
+
+        Accepts primary keys, instances or a queryset of systems. Their pillar
+        data is rendered again in the background once the transaction commits.
+        """
+        pks = list(cls.objects.filter(pk__in=systems).values_list("pk", flat=True))
+        if not pks:
+            return 0
+        count = cls.objects.filter(pk__in=pks).update(modified=Now())
+        cls.rebuild(pks)
+        return count
+
+    @classmethod
+    def rebuild(cls, pks):
+        rebuilder.schedule(pks)
+
     @classmethod
     def post_save(cls, sender, instance, created, *args, **kwargs):
-        for host in instance.host_set.all():
-            task = CommandTasks().run.delay(
-                tgt_type="compound",
-                tgt=f"G@host:{host.name}",
-                fun="state.apply",
-                arg=["outpost"],
-            )
-            logger.debug(f"Scheduled host state sync for {host} as {task.id}")
+        hosts = instance.host_set.values_list("name", flat=True)
+        dispatcher.schedule("outpost", hosts, instance)
+        logger.debug(f"Scheduled host state sync for {instance}")
+        cls.rebuild([instance.pk])
+        Change.record("system", [(instance.pk, instance.pk)])
 
 
 post_save.connect(System.post_save, sender=System)
@@ -241,10 +358,21 @@ class UserDirectory(models.Model):
     template = models.TextField()
     permissions = models.CharField(max_length=4, default="0700")
 
+    @classmethod
+    def touch(cls, sender, instance, *args, **kwargs):
+        System.touch([instance.system_id])
+        Change.record(
+            "directory", [(instance.system_id, instance.pk)], Change.action_of(**kwargs)
+        )
+
     def __str__(self):
         return f"{self.system}: {self.template}"
 
 
+post_save.connect(UserDirectory.touch, sender=UserDirectory)
+post_delete.connect(UserDirectory.touch, sender=UserDirectory)
+
+
 class Host(models.Model):
     name = models.CharField(max_length=64, unique=True, db_index=True)
     system = models.ForeignKey(
@@ -264,13 +392,8 @@ class Host(models.Model):
     def post_save(cls, sender, instance, created, *args, **kwargs):
         if not created:
             return
-        task = CommandTasks().run.delay(
-            tgt_type="compound",
-            tgt=f"G@host:{instance.name}",
-            fun="state.apply",
-            arg=["outpost"],
-        )
-        logger.debug(f"Scheduled host sync for {instance} as {task.id}")
+        dispatcher.schedule("outpost", [instance.name], instance)
+        logger.debug(f"Scheduled host sync for {instance}")
 
 
 post_save.connect(Host.post_save, sender=Host)
@@ -285,23 +408,117 @@ class SystemUser(models.Model):
 
     @classmethod
     def post_save(cls, sender, instance, created, *args, **kwargs):
-        for group in instance.groups.all():
-            if group not in instance.system.group_set.all():
-                instance.system.group_set.add(group)
-        for host in instance.system.host_set.all():
-            task = CommandTasks().run.delay(
-                tgt_type="compound",
-                tgt=f"G@host:{host.name}",
-                fun="state.apply",
-                arg=["outpost"],
+        hosts = instance.system.host_set.values_list("name", flat=True)
+        dispatcher.schedule("outpost", hosts, instance)
+        logger.debug(f"Scheduled user sync for {instance}")
+
+    @classmethod
+    def touch(cls, sender, instance, *args, **kwargs):
+        System.touch([instance.system_id])
+        Change.record(
+            "user", [(instance.system_id, instance.user_id)], Change.action_of(**kwargs)
+        )
+
+    @classmethod
+    def provision(cls, system, usernames, groups=(), **defaults):
+        """
+        Add users to a system in bulk.
+
+        Users are resolved in batches and created from their campusonline
+        persons if needed. System users and their group links are inserted
+        with `bulk_create` and one sync is scheduled for the hosts of the
+        system. Returns the created system users and unknown usernames.
+        """
+        usernames = set(usernames)
+        groups = list(groups)
+        with transaction.atomic():
+            users = User.resolve(usernames)
+            for subclass in (StaffUser, ExternalUser, StudentUser):
+                missing = usernames - users.keys()
+                if not missing:
+                    break
+                persons = subclass.campusonline.objects.filter(username__in=missing)
+                for person in persons:
+                    users[person.username] = subclass.objects.create(person=person)
+            existing = set(
+                cls.objects.filter(system=system, user__in=users.values()).values_list(
+                    "user_id", flat=True
+                )
+            )
+            created = cls.objects.bulk_create(
+                [
+                    cls(system=system, user=user, **defaults)
+                    for user in users.values()
+                    if user.pk not in existing
+                ]
+            )
+            if groups:
+                cls.groups.through.objects.bulk_create(
+                    [
+                        cls.groups.through(systemuser_id=su.pk, group_id=group.pk)
+                        for su in created
+                        for group in groups
+                    ]
+                )
+                linked = set(system.group_set.values_list("pk", flat=True))
+                missing = [g for g in groups if g.pk not in linked]
+                if missing:
+                    system.group_set.add(*missing)
+            if created:
+                System.touch([system.pk])
+                Change.record(
+                    "user", [(system.pk, su.user_id) for su in created], Change.CREATED
+                )
+                hosts = system.host_set.values_list("name", flat=True)
+                dispatcher.schedule("outpost", hosts)
+        return created, usernames - users.keys()
+
+    @classmethod
+    def propagate(cls, sender, instance, action, reverse, pk_set, **kwargs):
+        """
+        Add groups assigned to system users to their systems as well.
+        """
+        if action != "post_add" or not pk_set:
+            return
+        if reverse:
+            systems = set(
+                cls.objects.filter(pk__in=pk_set).values_list("system_id", flat=True)
             )
-            logger.debug(f"Scheduled user sync for {host} as {task.id}")
+            linked = set(instance.systems.values_list("pk", flat=True))
+            missing = systems - linked
+            if missing:
+                instance.systems.add(*missing)
+        else:
+            linked = set(instance.system.group_set.values_list("pk", flat=True))
+            missing = pk_set - linked
+            if missing:
+                instance.system.group_set.add(*missing)
+
+    @classmethod
+    def touch_groups(cls, sender, instance, action, reverse, pk_set, **kwargs):
+        if action not in ("post_add", "post_remove", "pre_clear"):
+            return
+        if not reverse:
+            references = [(instance.system_id, instance.user_id)]
+        elif pk_set is None:
+            references = instance.systemuser_set.values_list("system_id", "user_id")
+        else:
+            references = cls.objects.filter(pk__in=pk_set).values_list(
+                "system_id", "user_id"
+            )
+        references = list(references)
+        System.touch([system for system, _ in references])
+        Change.record("user", references)
 
     def __str__(self):
         return f"{self.user.person.username}@{self.system} (self.user)"
 
 
 post_save.connect(SystemUser.post_save, sender=SystemUser)
+post_save.connect(SystemUser.touch, sender=SystemUser)
+post_delete.connect(SystemUser.touch, sender=SystemUser)
+m2m_changed.connect(SystemUser.propagate, sender=SystemUser.groups.through)
+m2m_changed.connect(SystemUser.touch_groups, sender=SystemUser.groups.through)
 
 
 class User(PolymorphicModel):
@@ -329,6 +546,36 @@ class User(PolymorphicModel):
     def __str__(self):
         return f"{self.person} ({self.username}:{self.pk})"
 
+    @classmethod
+    def prefetch_persons(cls, users):
+        """
+        Prefetch the campusonline person for a mixed list of polymorphic users.
+
+        Each subclass points to a different campusonline model, so the users are
+        grouped by their concrete class and prefetched with one query per class.
+        """
+        subclasses = defaultdict(list)
+        for user in users:
+            subclasses[user.__class__].append(user)
+        for instances in subclasses.values():
+            prefetch_related_objects(instances, "person")
+
+    @classmethod
+    def resolve(cls, usernames):
+        """
+        Map usernames to existing users with one query per user subclass.
+        """
+        usernames = set(usernames)
+        users = dict()
+        for subclass in (StaffUser, ExternalUser, StudentUser):
+            missing = usernames - users.keys()
+            if not missing:
+                break
+            qs = subclass.objects.filter(person__username__in=missing)
+            for user in qs.select_related("person"):
+                users[user.person.username] = user
+        return users
+
     @classmethod
     def update(cls, sender, request, user, **kwargs):
         username = getattr(user, user.USERNAME_FIELD)
@@ -345,6 +592,13 @@ class User(PolymorphicModel):
                 suser.local = user
                 suser.save()
 
+    @classmethod
+    def touch(cls, sender, instance, raw, *args, **kwargs):
+        if raw:
+            return
+        System.touch(System.objects.filter(systemuser__user_id=instance.pk))
+        Change.record_users("user", [instance.pk])
+
 
 class StaffUser(User):
     campusonline = Person
@@ -370,6 +624,9 @@ class StudentUser(User):
 user_logged_in.connect(StaffUser.update)
 user_logged_in.connect(ExternalUser.update)
 user_logged_in.connect(StudentUser.update)
+post_save.connect(User.touch, sender=StaffUser)
+post_save.connect(User.touch, sender=ExternalUser)
+post_save.connect(User.touch, sender=StudentUser)
 
 
 class Group(models.Model):
@@ -385,18 +642,44 @@ class Group(models.Model):
 
     @classmethod
     def post_save(cls, sender, instance, created, *args, **kwargs):
-        for system in instance.systems.all():
-            for host in system.host_set.all():
-                task = CommandTasks().run.delay(
-                    tgt_type="compound",
-                    tgt=f"G@host:{host.name}",
-                    fun="state.apply",
-                    arg=["outpost.groups"],
-                )
-                logger.debug(f"Scheduled group sync for {host} as {task.id}")
+        hosts = Host.objects.filter(
+            system__in=instance.systems.all()
+        ).values_list("name", flat=True)
+        dispatcher.schedule("outpost.groups", hosts, instance)
+        logger.debug(f"Scheduled group sync for {instance}")
+
+    @classmethod
+    def touch(cls, sender, instance, *args, **kwargs):
+        systems = list(instance.systems.values_list("pk", flat=True))
+        System.touch(systems)
+        Change.record(
+            "group", [(s, instance.pk) for s in systems], Change.action_of(**kwargs)
+        )
+
+    @classmethod
+    def touch_systems(cls, sender, instance, action, reverse, pk_set, **kwargs):
+        if action not in ("post_add", "post_remove", "pre_clear"):
+            return
+        if reverse:
+            if pk_set is None:
+                pk_set = instance.group_set.values_list("pk", flat=True)
+            references = [(instance.pk, group) for group in pk_set]
+        else:
+            if pk_set is None:
+                pk_set = instance.systems.values_list("pk", flat=True)
+            references = [(system, instance.pk) for system in pk_set]
+        System.touch({system for system, _ in references})
+        Change.record(
+            "group",
+            references,
+            Change.CREATED if action == "post_add" else Change.DELETED,
+        )
 
 
 post_save.connect(Group.post_save, sender=Group)
+post_save.connect(Group.touch, sender=Group)
+pre_delete.connect(Group.touch, sender=Group)
+m2m_changed.connect(Group.touch_systems, sender=Group.systems.through)
 
 
 class Permission(models.Model):
@@ -411,6 +694,60 @@ class Permission(models.Model):
             return f"{self.user}: {self.function}"
         return f"{self.user}@{self.system}: {self.function}"
 
+    @classmethod
+    def eauth(cls, user):
+        """
+        Build the Salt eauth structure for a user.
+
+        Permissions without a system apply to all minions and are returned as
+        plain function expressions, all others are grouped by host name. The
+        hosts of all permissions are resolved in a single query and functions
+        already granted globally are not repeated for individual hosts.
+        """
+        functions = dict()
+        hosts = defaultdict(dict)
+        rows = (
+            cls.objects.filter(user=user)
+            .order_by("pk")
+            .values_list("system_id", "system__host__name", "function")
+        )
+        for system, host, function in rows:
+            if system is None:
+                functions[function] = None
+            elif host is not None:
+                hosts[host][function] = None
+        eauth = list(functions)
+        for host, granted in sorted(hosts.items()):
+            granted = [f for f in granted if f not in functions]
+            if granted:
+                eauth.append({host: granted})
+        return eauth
+
+    @classmethod
+    def cache_key(cls, user):
+        """
+        Cache key for the eauth permissions of an authenticated user.
+
+        The key includes a generation token which is replaced whenever a
+        permission, host or system changes, invalidating all cached entries.
+        """
+        generation = cache.get_or_set(f"{__name__}.eauth", uuid4().hex, None)
+        ident = f"{user._meta.label}:{user.pk}:{generation}".encode("utf-8")
+        return f"{__name__}.eauth:{sha256(ident).hexdigest()}"
+
+    @classmethod
+    def invalidate(cls, sender, instance, *args, **kwargs):
+        logger.debug(f"Invalidating cached eauth permissions for {instance}")
+        cache.set(f"{__name__}.eauth", uuid4().hex, None)
+
+
+post_save.connect(Permission.invalidate, sender=Permission)
+post_delete.connect(Permission.invalidate, sender=Permission)
+post_save.connect(Permission.invalidate, sender=Host)
+post_delete.connect(Permission.invalidate, sender=Host)
+post_save.connect(Permission.invalidate, sender=System)
+post_delete.connect(Permission.invalidate, sender=System)
+
 
 class Job(models.Model):
     id = models.CharField(max_length=20, primary_key=True)
@@ -440,3 +777,192 @@ class Result(models.Model):
 
     def __str__(self):
         return f"{self.target}: {self.function} @ {self.modified}"
+
+
+class Dispatch(models.Model):
+    state = models.CharField(max_length=128)
+    hosts = ArrayField(models.CharField(max_length=64))
+    origins = ArrayField(models.TextField(), default=list, blank=True)
+    jids = ArrayField(models.CharField(max_length=20), default=list, blank=True)
+    minions = ArrayField(models.TextField(), default=list, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    sent = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ("-created",)
+        indexes = (GinIndex(fields=("jids",), name="salt_dispatch_jids"),)
+
+    def __str__(self):
+        return f"{self.state} on {len(self.hosts)} hosts ({self.pk})"
+
+    @classmethod
+    def with_returns(cls, qs):
+        return qs.annotate(
+            returns=models.Count("dispatchreturn"),
+            last_return=models.Max("dispatchreturn__received"),
+        )
+
+    @property
+    def completion(self):
+        if not self.minions:
+            return None
+        returns = getattr(self, "returns", None)
+        if returns is None:
+            returns = self.dispatchreturn_set.count()
+        return returns / len(self.minions)
+
+    @property
+    def latency(self):
+        if not self.sent:
+            return None
+        if hasattr(self, "last_return"):
+            last = self.last_return
+        else:
+            last = self.dispatchreturn_set.aggregate(last=models.Max("received"))
+            last = last.get("last")
+        if not last:
+            return None
+        return last - self.sent
+
+    @classmethod
+    def record(cls, pk, returned):
+        """
+        Store jobs IDs and targeted minions returned by Salt API for a dispatch.
+        """
+        jids = [r.get("jid") for r in returned if r.get("jid")]
+        minions = sorted({m for r in returned for m in r.get("minions", [])})
+        cls.objects.filter(pk=pk).update(
+            sent=timezone.now(), jids=jids, minions=minions
+        )
+
+
+class DispatchReturn(models.Model):
+    dispatch = models.ForeignKey("Dispatch", on_delete=models.CASCADE)
+    minion = models.TextField()
+    success = models.BooleanField()
+    received = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = (("dispatch", "minion"),)
+
+    def __str__(self):
+        return f"{self.dispatch}: {self.minion}"
+
+    @classmethod
+    def receive(cls, sender, data, **kwargs):
+        parts = data.get("tag", "").split("/", 4)
+        if len(parts) != 5 or parts[:2] != ["salt", "job"] or parts[3] != "ret":
+            return
+        dispatches = Dispatch.objects.filter(jids__contains=[parts[2]])
+        payload = data.get("data", {})
+        cls.objects.bulk_create(
+            [
+                cls(
+                    dispatch_id=pk,
+                    minion=parts[4],
+                    success=payload.get("success", payload.get("retcode") == 0),
+                )
+                for pk in dispatches.values_list("pk", flat=True)
+            ],
+            ignore_conflicts=True,
+        )
+
+
+event.connect(DispatchReturn.receive)
+
+
+class Change(models.Model):
+    """
+    Journal of changes to the pillar data of a system.
+    """
+
+    CREATED = "created"
+    MODIFIED = "modified"
+    DELETED = "deleted"
+
+    margin = timedelta(hours=1)
+
+    system = models.ForeignKey("System", db_constraint=False, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=16)
+    reference = models.TextField()
+    action = models.CharField(max_length=8)
+    txid = models.BigIntegerField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ("pk",)
+        indexes = (
+            models.Index(fields=("system", "txid"), name="salt_change_system"),
+        )
+
+    def __str__(self):
+        return f"{self.system_id}: {self.action} {self.kind} {self.reference}"
+
+    @classmethod
+    def action_of(cls, signal=None, created=False, **kwargs):
+        if signal in (pre_delete, post_delete):
+            return cls.DELETED
+        return cls.CREATED if created else cls.MODIFIED
+
+    @classmethod
+    def record(cls, kind, references, action=MODIFIED):
+        cls.objects.bulk_create(
+            [
+                cls(
+                    system_id=system,
+                    kind=kind,
+                    reference=str(reference),
+                    action=action,
+                    txid=Func(
+                        function="txid_current", output_field=models.BigIntegerField()
+                    ),
+                )
+                for system, reference in references
+            ]
+        )
+
+    @classmethod
+    def record_files(cls, systemfiles, action=MODIFIED, path=None):
+        references = []
+        systems = set()
+        for systemfile in systemfiles:
+            try:
+                resolved = systemfile.resolve(path or systemfile.file.path)
+            except ObjectDoesNotExist:
+                # Owner lost their person, path can not be resolved.
+                systems.add(systemfile.system_id)
+                continue
+            references.append((systemfile.system_id, resolved))
+        cls.record("file", references, action)
+        cls.record("system", [(s, s) for s in systems])
+
+    @classmethod
+    def record_users(cls, kind, users, action=MODIFIED):
+        references = SystemUser.objects.filter(user__in=users).values_list(
+            "system_id", "user_id"
+        )
+        cls.record(kind, references, action)
+
+    @classmethod
+    def version(cls, system):
+        # Oldest running transaction, entries committed later are not missed.
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT txid_snapshot_xmin(txid_current_snapshot())")
+            (txid,) = cursor.fetchone()
+        return f"{system.pk}:{txid}:{int(timezone.now().timestamp())}"
+
+    @classmethod
+    def since(cls, system, version):
+        """
+        Transaction ID to read entries from or `None` for a full pillar.
+        """
+        try:
+            pk, txid, issued = map(int, str(version).split(":"))
+        except ValueError:
+            return None
+        if pk != system.pk:
+            return None
+        oldest = timezone.now() - settings.SALT_CHANGES_RETENTION + cls.margin
+        if issued < oldest.timestamp():
+            return None
+        return txid
@@ -0,0 +1,147 @@
+import logging
+from datetime import (
+    date,
+    datetime,
+)
+
+from django.db import (
+    DatabaseError,
+    transaction,
+)
+from django.db import connection as default_connection
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS salt_job (
+        id varchar(20) PRIMARY KEY,
+        data jsonb NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS salt_result (
+        id bigserial,
+        function varchar(50) NOT NULL,
+        job_id varchar(20) NOT NULL,
+        result jsonb NOT NULL,
+        data jsonb NOT NULL,
+        target varchar(255) NOT NULL,
+        success boolean NOT NULL,
+        modified timestamp with time zone NOT NULL,
+        PRIMARY KEY (id, modified)
+    ) PARTITION BY RANGE (modified)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS salt_result_default
+    PARTITION OF salt_result DEFAULT
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS salt_result_target_modified
+    ON salt_result (target, modified)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS salt_result_function_success_modified
+    ON salt_result (function, success, modified)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS salt_result_data
+    ON salt_result USING GIN (data)
+    """,
+)
+
+
+def month(day, offset=0):
+    index = day.year * 12 + day.month - 1 + offset
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def kind(connection=default_connection):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT relkind FROM pg_class WHERE oid = to_regclass('salt_result')"
+        )
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def create(connection=default_connection):
+    """
+    Create `salt_job` and a `salt_result` table partitioned by month.
+
+    Results outside of all monthly partitions end up in a default partition
+    instead of being rejected. Missing parts of an existing partitioned table
+    are added. A `salt_result` table which is not partitioned has to be
+    migrated by hand.
+    """
+    existing = kind(connection)
+    if existing not in (None, "p"):
+        logger.warning("Table salt_result exists and is not partitioned")
+        return False
+    with connection.cursor() as cursor:
+        for statement in SCHEMA:
+            cursor.execute(statement)
+    return True
+
+
+def partitions(connection=default_connection):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT c.relname
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass('salt_result')
+            ORDER BY c.relname
+            """
+        )
+        return [
+            (name, datetime.strptime(name[-6:], "%Y%m").date())
+            for name, in cursor.fetchall()
+            if name[-6:].isdigit()
+        ]
+
+
+def extend(today, ahead, connection=default_connection):
+    """
+    Create monthly partitions from the current month up to `ahead` months.
+
+    A partition can not be created while the default partition holds rows
+    for its month, these have to be moved by hand.
+    """
+    with connection.cursor() as cursor:
+        for offset in range(ahead + 1):
+            start = month(today, offset)
+            name = f"salt_result_{start:%Y%m}"
+            try:
+                with transaction.atomic(using=connection.alias):
+                    cursor.execute(
+                        f"""
+                        CREATE TABLE IF NOT EXISTS {name}
+                        PARTITION OF salt_result
+                        FOR VALUES FROM (%s) TO (%s)
+                        """,
+                        [start, month(start, 1)],
+                    )
+            except DatabaseError as e:
+                logger.error(f"Could not create partition {name}: {e}")
+
+
+def prune(cutoff, connection=default_connection):
+    """
+    Drop partitions holding only results older than `cutoff`.
+
+    Jobs are removed by comparing their IDs, which start with a timestamp, so
+    no table has to be scanned for old rows.
+    """
+    dropped = []
+    with connection.cursor() as cursor:
+        for name, start in partitions(connection):
+            if month(start, 1) <= cutoff:
+                logger.info(f"Dropping partition {name}")
+                cursor.execute(f"DROP TABLE {name}")
+                dropped.append(name)
+        cursor.execute(
+            "DELETE FROM salt_job WHERE id < %s", [f"{cutoff:%Y%m%d}000000000000"]
+        )
+    return dropped
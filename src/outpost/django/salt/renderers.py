@@ -0,0 +1,25 @@
+import json
+
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+
+class NDJSONRenderer(BaseRenderer):
+    """
+    Render a list as newline-delimited JSON, one object per line.
+    """
+
+    media_type = "application/x-ndjson"
+    format = "ndjson"
+    charset = "utf-8"
+
+    @staticmethod
+    def line(data):
+        return json.dumps(data, cls=JSONEncoder, ensure_ascii=False) + "\n"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        if not isinstance(data, list):
+            data = [data]
+        return "".join(self.line(d) for d in data).encode(self.charset)
@@ -1,6 +1,11 @@
 import logging
 
 # import gpg
+from django.core.cache import cache
+from django.db.models import (
+    Manager,
+    Prefetch,
+)
 from rest_framework import serializers
 
 from . import models
@@ -41,7 +46,9 @@ class GroupSerializer(serializers.ModelSerializer):
 
 class SystemUserActiveFilterListSerializer(serializers.ListSerializer):
     def to_representation(self, data):
-        return super().to_representation(data.filter(user__active=True))
+        # Filter in Python so a prefetched systemuser_set is not queried again.
+        iterable = data.all() if isinstance(data, Manager) else data
+        return super().to_representation([su for su in iterable if su.user.active])
 
 
 class SystemUserSerializer(serializers.ModelSerializer):
@@ -72,11 +79,13 @@ class SystemUserSerializer(serializers.ModelSerializer):
         return o.system.home_template.format(username=o.user.person.username)
 
     def get_directories(self, o):
-        for d in o.system.userdirectory_set.all():
-            yield {
+        return [
+            {
                 "path": d.template.replace("{username}", o.user.person.username),
                 "permissions": d.permissions,
             }
+            for d in o.system.userdirectory_set.all()
+        ]
 
 
 class SystemFileSerializer(serializers.ModelSerializer):
@@ -102,9 +111,143 @@ class SystemSerializer(serializers.ModelSerializer):
         model = models.System
         fields = ("name", "users", "groups", "files")
 
+    @staticmethod
+    def prefetch(qs):
+        """
+        Prefetch everything rendered for systems, so the number of queries
+        does not depend on the number of users, keys, groups or files.
+
+        Together with `User.prefetch_persons` in `render` this replaces the
+        prefetching previously done by `HostViewSet`.
+        """
+        return qs.prefetch_related(
+            "group_set",
+            "userdirectory_set",
+            Prefetch(
+                "systemuser_set",
+                queryset=models.SystemUser.objects.filter(
+                    user__active=True
+                ).prefetch_related(
+                    "groups",
+                    Prefetch(
+                        "user",
+                        queryset=models.User.objects.prefetch_related(
+                            "publickey_set"
+                        ),
+                    ),
+                ),
+            ),
+            Prefetch(
+                "systemfile_set",
+                queryset=models.SystemFile.objects.select_related(
+                    "file"
+                ).prefetch_related(
+                    Prefetch("file__user", queryset=models.User.objects.all())
+                ),
+            ),
+        )
+
+    @staticmethod
+    def cache_key(system):
+        return f"{__name__}.system:{system.pk}:{system.modified.timestamp()}"
+
+    @classmethod
+    def render(cls, systems):
+        """
+        Serialize systems with all related objects prefetched and cache the
+        result under a key bound to their modification time.
+        """
+        systems = list(cls.prefetch(models.System.objects.filter(pk__in=systems)))
+        users = [su.user for s in systems for su in s.systemuser_set.all()]
+        users.extend(sf.file.user for s in systems for sf in s.systemfile_set.all())
+        models.User.prefetch_persons(users)
+        rendered = {s.pk: cls(s).data for s in systems}
+        cache.set_many(
+            {cls.cache_key(s): rendered[s.pk] for s in systems},
+            settings.SALT_PILLAR_CACHE_TIMEOUT,
+        )
+        return rendered
+
+    @staticmethod
+    def delta(pillar, changes):
+        """
+        Split journal entries into added, modified and removed pillar entries.
+
+        Entries still present in the pillar are taken from it, the first
+        action seen for an entry tells whether it was added. Changes to user
+        directories affect every user, so the directories of all users are
+        returned.
+        """
+        users = {str(u["uid"]): u for u in pillar["users"]}
+        sections = {
+            "user": ("users", users, lambda u: u, int),
+            "key": (
+                "keys",
+                users,
+                lambda u: {"uid": u["uid"], "public_keys": u["public_keys"]},
+                int,
+            ),
+            "group": (
+                "groups",
+                {str(g["gid"]): g for g in pillar["groups"]},
+                lambda g: g,
+                int,
+            ),
+            "file": (
+                "files",
+                {f["path"]: f for f in pillar["files"]},
+                lambda f: f,
+                str,
+            ),
+        }
+        actions = dict()
+        for change in changes:
+            actions.setdefault((change.kind, change.reference), change.action)
+        data = {
+            name: {"added": [], "modified": [], "removed": []}
+            for name, *_ in sections.values()
+        }
+        for (kind, reference), action in actions.items():
+            if kind not in sections:
+                continue
+            name, current, extract, parse = sections[kind]
+            if reference not in current:
+                data[name]["removed"].append(parse(reference))
+            elif action == models.Change.CREATED:
+                data[name]["added"].append(extract(current[reference]))
+            else:
+                data[name]["modified"].append(extract(current[reference]))
+        data["directories"] = {"modified": []}
+        if any(kind == "directory" for kind, _ in actions):
+            data["directories"]["modified"] = [
+                {"uid": u["uid"], "directories": u["directories"]}
+                for u in pillar["users"]
+            ]
+        return data
+
+    @classmethod
+    def cached(cls, system):
+        data = cache.get(cls.cache_key(system))
+        if data is None:
+            data = cls.render([system.pk]).get(system.pk)
+        return data
+
+
+class CachedSystemField(serializers.Field):
+    """
+    Read-only system pillar taken from the cache and rendered on a miss.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs["read_only"] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        return SystemSerializer.cached(value)
+
 
 class HostSerializer(serializers.ModelSerializer):
-    system = SystemSerializer()
+    system = CachedSystemField()
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -116,7 +259,57 @@ class HostSerializer(serializers.ModelSerializer):
         extensions = dict()
 
 
+class ProvisionSerializer(serializers.Serializer):
+    system = serializers.PrimaryKeyRelatedField(queryset=models.System.objects.all())
+    usernames = serializers.ListField(child=serializers.CharField())
+    groups = serializers.PrimaryKeyRelatedField(
+        queryset=models.Group.objects.all(), many=True, required=False
+    )
+    shell = serializers.CharField(required=False)
+    sudo = serializers.BooleanField(default=False)
+
+
 class FileSerializer(serializers.ModelSerializer):
     class Meta:
         model = models.File
         fields = ("path", "systems", "permissions")
+
+
+class DeferredFieldsMixin(object):
+    """
+    Drop large fields unless they are requested in the `expand` context.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        expand = self.context.get("expand", ())
+        for name in self.Meta.deferred:
+            if name not in expand:
+                self.fields.pop(name)
+
+
+class JobSerializer(DeferredFieldsMixin, serializers.ModelSerializer):
+    jid = serializers.CharField(source="pk")
+
+    class Meta:
+        model = models.Job
+        fields = ("jid", "data")
+        deferred = ("data",)
+
+
+class ResultSerializer(DeferredFieldsMixin, serializers.ModelSerializer):
+    jid = serializers.CharField(source="job_id")
+
+    class Meta:
+        model = models.Result
+        fields = (
+            "id",
+            "jid",
+            "target",
+            "function",
+            "success",
+            "modified",
+            "result",
+            "data",
+        )
+        deferred = ("result", "data")
@@ -0,0 +1,94 @@
+import hashlib
+import logging
+
+from django.core.files.storage import (
+    Storage,
+    default_storage,
+)
+from django.db import connection
+from django.utils.deconstruct import deconstructible
+
+logger = logging.getLogger(__name__)
+
+
+def lock(name):
+    """
+    Serialize reuse and removal of a blob until the current transaction ends.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", [name])
+
+
+@deconstructible
+class ContentAddressedStorage(Storage):
+    """
+    Store files under the SHA-256 digest of their content.
+
+    All operations are delegated to the wrapped `storage`, but the name given on
+    saving is replaced by one derived from the digest, so identical content is
+    only stored once and shared by all `File` objects referencing it. The
+    digest is taken from the `sha256` attribute of the content if present.
+
+    Use it as `SALT_FILE_STORAGE = ContentAddressedStorage(SomeStorage(...))`.
+    Unreferenced blobs are removed when the last `File` using them is deleted.
+    Both saving and removing a blob take a lock on its name which is held
+    until the surrounding transaction ends, so a blob can not be removed
+    between being reused and the new reference being committed.
+    """
+
+    def __init__(self, storage=None, prefix=""):
+        self.storage = storage or default_storage
+        self.prefix = prefix
+
+    def blob(self, digest):
+        return f"{self.prefix}{digest[:2]}/{digest}"
+
+    def digest(self, content):
+        sha256 = getattr(content, "sha256", None)
+        if sha256:
+            return sha256
+        hash = hashlib.sha256()
+        for chunk in content.chunks():
+            hash.update(chunk)
+        return hash.hexdigest()
+
+    def get_available_name(self, name, max_length=None):
+        return name
+
+    def _save(self, name, content):
+        name = self.blob(self.digest(content))
+        lock(name)
+        if self.storage.exists(name):
+            logger.debug(f"Reusing existing blob {name}")
+            return name
+        return self.storage.save(name, content)
+
+    def _open(self, name, mode="rb"):
+        return self.storage.open(name, mode)
+
+    def delete(self, name):
+        return self.storage.delete(name)
+
+    def exists(self, name):
+        return self.storage.exists(name)
+
+    def listdir(self, path):
+        return self.storage.listdir(path)
+
+    def size(self, name):
+        return self.storage.size(name)
+
+    def url(self, name):
+        return self.storage.url(name)
+
+    def path(self, name):
+        return self.storage.path(name)
+
+    def get_accessed_time(self, name):
+        return self.storage.get_accessed_time(name)
+
+    def get_created_time(self, name):
+        return self.storage.get_created_time(name)
+
+    def get_modified_time(self, name):
+        return self.storage.get_modified_time(name)
@@ -3,10 +3,20 @@ from datetime import timedelta
 
 import requests
 from celery import shared_task
-from django.core.exceptions import ObjectDoesNotExist
+from django.contrib.postgres.aggregates import StringAgg
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import (
+    Exists,
+    Func,
+    OuterRef,
+    TextField,
+)
+from django.db.models.functions import Cast
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
-from purl import URL
 
+from .client import SaltClient
 from .conf import settings
 
 logger = logging.getLogger(__name__)
@@ -15,45 +25,240 @@ logger = logging.getLogger(__name__)
 class UserTasks:
     run_every = timedelta(minutes=5)
 
+    @staticmethod
+    def changes(cls):
+        """
+        Find persons of a user subclass that appeared or disappeared.
+
+        Only persons referenced by users are considered. Their primary keys are
+        compared to the state of the previous run, but only if a checksum over
+        them calculated by the database differs. Returns the new state and the
+        changed persons, which are `None` if no previous state is known.
+        """
+        key = f"{__name__}.cleanup:{cls._meta.label}"
+        persons = cls.campusonline.objects.filter(
+            pk__in=cls.objects.values("person_id")
+        )
+        checksum = persons.aggregate(
+            checksum=Func(
+                StringAgg(Cast("pk", TextField()), ",", ordering="pk"),
+                function="MD5",
+                output_field=TextField(),
+            )
+        ).get("checksum")
+        previous = cache.get(key)
+        if previous and previous.get("checksum") == checksum:
+            return {key: previous}, set()
+        current = set(persons.values_list("pk", flat=True))
+        state = {key: {"checksum": checksum, "persons": current}}
+        if not previous:
+            return state, None
+        return state, current ^ previous.get("persons")
+
+    @staticmethod
+    def reconcile(cls, persons=None):
+        """
+        Align the `active` flag of one user subclass with its campusonline model.
+
+        Users are matched against their backing person with an anti-join so
+        only rows whose flag has to change are returned by the database. If
+        `persons` is given only users of these persons are examined. Returns
+        the number of examined users and the primary keys of changed users.
+        """
+        from .models import User
+
+        qs = cls.objects.all()
+        if persons is not None:
+            qs = qs.filter(person_id__in=persons)
+        examined = qs.count()
+        qs = qs.annotate(
+            exists=Exists(cls.campusonline.objects.filter(pk=OuterRef("person_id")))
+        )
+        changed = []
+        for active, action in ((False, "Reactivating"), (True, "Deactivating")):
+            pks = list(
+                qs.filter(active=active, exists=not active).values_list("pk", flat=True)
+            )
+            for pk in pks:
+                logger.info(f"{action} {cls._meta.label} with PK {pk}")
+            if pks:
+                User.objects.filter(pk__in=pks).update(active=not active)
+            changed.extend(pks)
+        return examined, changed
+
     @shared_task(bind=True, ignore_result=True, name=f"{__name__}.User:cleanup")
     def cleanup(task):
-        from .models import User
+        """
+        Deactivate users whose person vanished and reactivate returning ones.
 
-        for u in User.objects.all():
-            try:
-                str(u.person)
-            except ObjectDoesNotExist:
-                if u.active:
-                    logger.info(f"Deactivating {u._meta.label} with PK {u.pk}")
-                    u.active = False
-                    u.save()
-            else:
-                if not u.active:
-                    logger.info(f"Reactivating {u._meta.label} with PK {u.pk}")
-                    u.active = True
-                    u.save()
+        In incremental mode only users whose persons changed since the last
+        run are examined. A full sweep over all users happens at most every
+        `SALT_CLEANUP_FULL_INTERVAL` or whenever the previous state is lost.
+        """
+        from .dispatch import dispatcher
+        from .models import (
+            Change,
+            ExternalUser,
+            Host,
+            StaffUser,
+            StudentUser,
+            System,
+        )
+
+        incremental = settings.SALT_CLEANUP_INCREMENTAL
+        full = not incremental or cache.add(
+            f"{__name__}.cleanup",
+            True,
+            settings.SALT_CLEANUP_FULL_INTERVAL.total_seconds(),
+        )
+        states = dict()
+        with transaction.atomic():
+            changed = []
+            for cls in (StaffUser, ExternalUser, StudentUser):
+                persons = None
+                if incremental:
+                    state, persons = UserTasks.changes(cls)
+                    states.update(state)
+                if full:
+                    persons = None
+                elif persons is not None and not persons:
+                    logger.debug(f"No changed persons for {cls._meta.label}")
+                    continue
+                examined, pks = UserTasks.reconcile(cls, persons)
+                logger.info(
+                    f"Examined {examined} {cls._meta.label} rows, changed {len(pks)} "
+                    f"({'full' if persons is None else 'incremental'})"
+                )
+                changed.extend(pks)
+            if changed:
+                hosts = (
+                    Host.objects.filter(system__systemuser__user__in=changed)
+                    .values_list("name", flat=True)
+                    .distinct()
+                )
+                dispatcher.schedule("outpost.users", hosts)
+                System.touch(System.objects.filter(systemuser__user__in=changed))
+                Change.record_users("user", changed)
+        cache.set_many(states, None)
+
+
+class SystemTasks:
+    @shared_task(bind=True, ignore_result=True, name=f"{__name__}.System:pillar")
+    def pillar(task, systems):
+        """
+        Render pillar data of systems unless it is cached for their current
+        modification time already.
+        """
+        from .models import System
+        from .serializers import SystemSerializer
+
+        keys = {
+            SystemSerializer.cache_key(s): s.pk
+            for s in System.objects.filter(pk__in=systems).only("pk", "modified")
+        }
+        cached = cache.get_many(keys.keys())
+        stale = [pk for key, pk in keys.items() if key not in cached]
+        if not stale:
+            return
+        SystemSerializer.render(stale)
+        logger.debug(f"Rendered pillar data for systems {stale}")
+
+
+class ChangeTasks:
+    run_every = timedelta(days=1)
+
+    @shared_task(bind=True, ignore_result=True, name=f"{__name__}.Change:retention")
+    def retention(task):
+        """
+        Remove journal entries older than `SALT_CHANGES_RETENTION`.
+        """
+        from .models import Change
+
+        cutoff = timezone.now() - settings.SALT_CHANGES_RETENTION
+        deleted = Change.objects.filter(created__lt=cutoff).delete()[0]
+        logger.info(f"Removed {deleted} journal entries")
+
+
+class DispatchTasks:
+    run_every = timedelta(days=1)
+
+    @shared_task(bind=True, ignore_result=True, name=f"{__name__}.Dispatch:retention")
+    def retention(task):
+        from .models import Dispatch
+
+        cutoff = timezone.now() - settings.SALT_DISPATCH_RETENTION
+        deleted = Dispatch.objects.filter(created__lt=cutoff).delete()[0]
+        logger.info(f"Removed {deleted} dispatches and their returns")
+
+
+class ResultTasks:
+    run_every = timedelta(days=1)
+
+    @shared_task(bind=True, ignore_result=True, name=f"{__name__}.Result:retention")
+    def retention(task):
+        """
+        Maintain the monthly partitions of `salt_result`.
+
+        Partitions for the next `SALT_RESULT_PARTITIONS_AHEAD` months are
+        created and those older than `SALT_RESULT_RETENTION` are dropped.
+        """
+        from . import partitions
+
+        if not settings.SALT_RESULT_PARTITIONED:
+            return
+        if partitions.kind() != "p":
+            logger.warning(
+                "Table salt_result is not partitioned, run create_result_partitions"
+            )
+            return
+        partitions.create()
+        now = timezone.now()
+        partitions.extend(now.date(), settings.SALT_RESULT_PARTITIONS_AHEAD)
+        partitions.prune((now - settings.SALT_RESULT_RETENTION).date())
 
 
 class CommandTasks:
+    @staticmethod
+    def targets(hosts):
+        """
+        Split hosts into compound targets of at most `SALT_TARGET_CHUNK_SIZE`.
+
+        Hosts are matched on the `SALT_TARGET_GRAIN` grain or, if it is unset,
+        as a list of minion IDs.
+        """
+        hosts = sorted(set(hosts))
+        size = settings.SALT_TARGET_CHUNK_SIZE
+        grain = settings.SALT_TARGET_GRAIN
+        for i in range(0, len(hosts), size):
+            chunk = hosts[i : i + size]
+            if grain:
+                yield " or ".join(f"G@{grain}:{h}" for h in chunk)
+            else:
+                yield "L@{}".format(",".join(chunk))
+
     @shared_task(bind=True, ignore_result=True, name=f"{__name__}.Command:run")
-    def run(task, **kwargs):
-        session = requests.Session()
-        session.headers.update({"Accept": "application/json"})
-        url = URL(settings.SALT_MANAGEMENT_URL)
-        kwargs.update(
-            {
-                "username": settings.SALT_MANAGEMENT_USER,
-                "password": settings.SALT_MANAGEMENT_PASSWORD,
-                "eauth": "rest",
-                "client": "local_async",
-            }
-        )
+    def run(task, hosts=None, dispatch=None, **kwargs):
+        if hosts is None:
+            lowstates = [kwargs]
+        else:
+            batch = settings.SALT_TARGET_BATCH
+            if batch:
+                # Async batching keeps local_async returning a job ID instead of
+                # blocking until all batches finished like local_batch does.
+                kwargs["batch"] = batch
+            lowstates = [
+                dict(kwargs, tgt_type="compound", tgt=t)
+                for t in CommandTasks.targets(hosts)
+            ]
         try:
-            logger.debug(f"Posting task with data to Salt API: {kwargs}")
-            result = session.post(url.add_path_segment("run").as_string(), json=kwargs)
-            result.raise_for_status()
+            logger.debug(f"Posting tasks with data to Salt API: {lowstates}")
+            result = SaltClient.instance().run_batch(lowstates)
         except requests.RequestException as e:
             logger.error(f"Failed to run task through Salt API: {e}")
             return
-        logger.debug(f"Scheduled job through Salt API: {result.text}")
-        return result.json()
+        logger.debug(f"Scheduled jobs through Salt API: {result}")
+        if dispatch:
+            from .models import Dispatch
+
+            Dispatch.record(dispatch, result)
+        return result
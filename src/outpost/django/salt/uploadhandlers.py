@@ -0,0 +1,54 @@
+import hashlib
+
+import magic
+from django.core.files import uploadhandler
+
+
+class DigestMixin(object):
+    """
+    Hash and identify an uploaded file while it is being received.
+
+    The SHA-256 digest is updated with every chunk and the MIME type is sniffed
+    from the first one. Both are attached to the completed file as `sha256` and
+    `mimetype` so the content never has to be read again.
+    """
+
+    def new_file(self, *args, **kwargs):
+        # Set up before the parent class may raise StopFutureHandlers.
+        self.sha256 = hashlib.sha256()
+        self.mimetype = None
+        super().new_file(*args, **kwargs)
+
+    def digest(self, raw_data, start):
+        if start == 0:
+            self.mimetype = magic.detect_from_content(raw_data).mime_type
+        self.sha256.update(raw_data)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is None:
+            return
+        if self.mimetype is None:
+            self.mimetype = magic.detect_from_content(b"").mime_type
+        file.sha256 = self.sha256.hexdigest()
+        file.mimetype = self.mimetype
+        return file
+
+
+class MemoryFileUploadHandler(DigestMixin, uploadhandler.MemoryFileUploadHandler):
+    def receive_data_chunk(self, raw_data, start):
+        if self.activated:
+            self.digest(raw_data, start)
+        return super().receive_data_chunk(raw_data, start)
+
+
+class TemporaryFileUploadHandler(
+    DigestMixin, uploadhandler.TemporaryFileUploadHandler
+):
+    def receive_data_chunk(self, raw_data, start):
+        self.digest(raw_data, start)
+        return super().receive_data_chunk(raw_data, start)
+
+
+def handlers(request):
+    return [MemoryFileUploadHandler(request), TemporaryFileUploadHandler(request)]
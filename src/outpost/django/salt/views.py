@@ -1,7 +1,12 @@
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.http import HttpResponseRedirect
 from django.urls import reverse_lazy as reverse
+from django.utils.decorators import method_decorator
 from django.utils.translation import gettext_lazy as _
+from django.views.decorators.csrf import (
+    csrf_exempt,
+    csrf_protect,
+)
 from django.views.generic import (
     CreateView,
     DeleteView,
@@ -14,6 +19,7 @@ from outpost.django.base.mixins import ContextMixin
 from . import (
     forms,
     models,
+    uploadhandlers,
 )
 
 
@@ -45,6 +51,14 @@ class FileMixin(object):
         return context
 
 
+class DigestUploadMixin(object):
+    @method_decorator(csrf_exempt)
+    def dispatch(self, request, *args, **kwargs):
+        # Upload handlers can only be replaced before the CSRF check reads POST.
+        request.upload_handlers = uploadhandlers.handlers(request)
+        return csrf_protect(super().dispatch)(request, *args, **kwargs)
+
+
 class PublicKeyListView(LoginRequiredMixin, PublicKeyMixin, ListView):
     model = models.PublicKey
 
@@ -70,7 +84,9 @@ class FileListView(LoginRequiredMixin, FileMixin, ListView):
     model = models.File
 
 
-class FileCreateView(LoginRequiredMixin, ContextMixin, FileMixin, CreateView):
+class FileCreateView(
+    DigestUploadMixin, LoginRequiredMixin, ContextMixin, FileMixin, CreateView
+):
     model = models.File
     success_url = reverse("salt:file")
     form_class = forms.FileForm
@@ -86,7 +102,9 @@ class FileCreateView(LoginRequiredMixin, ContextMixin, FileMixin, CreateView):
         return HttpResponseRedirect(self.get_success_url())
 
 
-class FileUpdateView(LoginRequiredMixin, ContextMixin, FileMixin, UpdateView):
+class FileUpdateView(
+    DigestUploadMixin, LoginRequiredMixin, ContextMixin, FileMixin, UpdateView
+):
     model = models.File
     success_url = reverse("salt:file")
     form_class = forms.FileForm
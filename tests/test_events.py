@@ -0,0 +1,32 @@
+import json
+from unittest import mock
+
+from django.test import (
+    SimpleTestCase,
+    override_settings,
+)
+
+from outpost.django.salt.events import Decoder
+
+
+def frame(tag, data):
+    # salt-api writes the payload before the tag.
+    return "data: " + json.dumps({"data": data, "tag": tag})
+
+
+@override_settings(SALT_EVENTS_INCLUDE=["*"], SALT_EVENTS_EXCLUDE=["salt/auth"])
+class DecoderTest(SimpleTestCase):
+    def test_excluded_tag_is_skipped_without_decoding(self):
+        decoder = Decoder()
+        decoder.loads = mock.Mock(side_effect=AssertionError("decoded"))
+        data = {"tag": "nested", "result": True, "_stamp": "2026-10-18T12:00:00"}
+        self.assertIsNone(decoder.decode(frame("salt/auth", data)))
+        self.assertEqual(decoder.skipped, 1)
+        decoder.loads.assert_not_called()
+
+    def test_wanted_tag_is_decoded(self):
+        decoder = Decoder()
+        data = {"fun": "state.apply", "id": "minion"}
+        decoded = decoder.decode(frame("salt/job/1/ret/minion", data))
+        self.assertEqual(decoded, {"data": data, "tag": "salt/job/1/ret/minion"})
+        self.assertEqual(decoder.skipped, 0)
@@ -0,0 +1,54 @@
+from types import SimpleNamespace
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from outpost.django.salt import models
+from outpost.django.salt.serializers import SystemSerializer
+
+
+def prefetch_persons(users):
+    # Campusonline persons live outside of the test database.
+    for user in users:
+        user._state.fields_cache["person"] = SimpleNamespace(
+            username=f"user{user.pk}", first_name="First", last_name="Last"
+        )
+
+
+@mock.patch.object(models.User, "prefetch_persons", prefetch_persons)
+class SystemSerializerQueriesTest(TestCase):
+    def setUp(self):
+        self.system = models.System.objects.create(name="test")
+        models.UserDirectory.objects.create(system=self.system, template="/srv/x")
+
+    def add_users(self, start, count):
+        for i in range(start, start + count):
+            user = models.StaffUser.objects.create(person_id=i)
+            group = models.Group.objects.create(id=i, name=f"group{i}")
+            group.systems.add(self.system)
+            systemuser = models.SystemUser.objects.create(
+                system=self.system, user=user
+            )
+            systemuser.groups.add(group)
+            models.PublicKey.objects.bulk_create(
+                [
+                    models.PublicKey(
+                        user=user, name="key", key="ssh-ed25519 AAAA", fingerprint="x"
+                    )
+                ]
+            )
+
+    def render(self):
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            SystemSerializer.render([self.system.pk])
+        return len(context.captured_queries)
+
+    def test_query_count_does_not_grow_with_users(self):
+        self.add_users(1, 1)
+        single = self.render()
+        self.add_users(2, 20)
+        self.assertEqual(self.render(), single)